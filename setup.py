@@ -28,7 +28,10 @@ setup(name='thinkhazard_processing',
       entry_points="""\
       [console_scripts]
       initialize_db = thinkhazard_processing.scripts.initializedb:main
+      download = thinkhazard_processing.scripts.download:main
+      prepare = thinkhazard_processing.scripts.prepare:main
       process = thinkhazard_processing.scripts.process:main
       decision_tree = thinkhazard_processing.scripts.decision_tree:main
+      benchmark = thinkhazard_processing.scripts.benchmark:main
       """,
       )
@@ -1,5 +1,5 @@
 import os
-import yaml
+from collections import MutableMapping
 
 from sqlalchemy.orm import (
     scoped_session,
@@ -15,6 +15,7 @@ models.DBSession = scoped_session(sessionmaker(
 
 
 def load_settings():
+    import yaml
     root_folder = os.path.join(os.path.dirname(__file__), '..')
     main_settings_path = os.path.join(root_folder,
                                       'thinkhazard_processing.yaml')
@@ -25,8 +26,61 @@ def load_settings():
                                        'local_settings.yaml')
     if os.path.exists(local_settings_path):
         with open(local_settings_path, 'r') as f:
-            settings.update(yaml.load(f.read()))
+            merge_settings(settings, yaml.load(f.read()))
 
     return settings
 
-settings = load_settings()
+
+def merge_settings(settings, overrides):
+    '''Update the settings with the overrides, key by key in the nested
+    sections, so that a section of the local settings only needs the keys
+    it changes.'''
+    for key, value in (overrides or {}).items():
+        if isinstance(value, dict) and isinstance(settings.get(key), dict):
+            merge_settings(settings[key], value)
+        else:
+            settings[key] = value
+
+
+class Settings(MutableMapping):
+    '''The settings, loaded from the YAML files when they are first used
+    rather than when the package is imported, so that the entry points
+    start fast. A load which fails is attempted again on the next use.'''
+
+    def __init__(self):
+        self._settings = None
+
+    @property
+    def loaded(self):
+        return self._settings is not None
+
+    def load(self):
+        if self._settings is None:
+            self._settings = load_settings()
+        return self._settings
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __setitem__(self, key, value):
+        self.load()[key] = value
+
+    def __delitem__(self, key):
+        del self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+    def __repr__(self):
+        return repr(self.load())
+
+    def copy(self):
+        return self.load().copy()
+
+    __copy__ = copy
+
+
+settings = Settings()
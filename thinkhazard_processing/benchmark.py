@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import math
+import time
+import datetime
+import subprocess
+import sys
+import numpy
+import pyproj
+import rasterio
+import transaction
+from affine import Affine
+from sqlalchemy import func
+from shapely.geometry import (
+    MultiPolygon,
+    Polygon,
+    )
+from geoalchemy2.shape import from_shape
+
+from thinkhazard_common.models import (
+    DBSession,
+    AdminLevelType,
+    AdministrativeDivision,
+    HazardLevel,
+    HazardType,
+    )
+from .models import (
+    HazardSet,
+    Layer,
+    catalogue,
+    )
+from .levels import build_hazardlevels
+from .metrics import metrics
+from .decision_tree import process_outputs
+from .processing import (
+    hazardset_layers,
+    process,
+    )
+from . import settings
+
+
+# extent of the synthetic divisions, in EPSG:4326, out of the poles where
+# EPSG:3857 is not defined
+EXTENT = (-170., -60., 170., 70.)
+
+# return periods of the synthetic layers, per level
+RETURN_PERIODS = {u'HIG': 250, u'MED': 475, u'LOW': 2475}
+
+# values of the synthetic layers relative to the threshold, per level, so
+# that each level is reached in a part of the divisions
+SCALES = {u'HIG': 1.2, u'MED': 1.6, u'LOW': 2.2}
+
+# entry points whose startup time is measured
+SCRIPTS = ('initializedb', 'prepare', 'process', 'decision_tree')
+
+# layers of the synthetic hazardsets have no data south of this latitude,
+# the divisions crossing it are partially covered
+NODATA_LATITUDE = -45.
+NODATA = -9999.
+
+
+def division_grid(countries, split):
+    '''Return the synthetic nested divisions as (level, code, parent code,
+    bounds in EPSG:4326) tuples. The extent is shared between `countries`
+    COU divisions laid out in a grid, each one being split into split x
+    split PRO divisions, themselves split into split x split REG ones.'''
+    columns = int(math.ceil(math.sqrt(countries)))
+    rows = int(math.ceil(float(countries) / columns))
+    minx, miny, maxx, maxy = EXTENT
+    width = (maxx - minx) / columns
+    height = (maxy - miny) / rows
+
+    divisions = []
+    codes = iter(xrange(1, 1 << 31))
+
+    def children(level, parent_code, bounds):
+        left, bottom, right, top = bounds
+        step_x = (right - left) / split
+        step_y = (top - bottom) / split
+        result = []
+        for row in range(split):
+            for col in range(split):
+                result.append((level, next(codes), parent_code, (
+                    left + col * step_x,
+                    bottom + row * step_y,
+                    left + (col + 1) * step_x,
+                    bottom + (row + 1) * step_y)))
+        return result
+
+    for i in range(countries):
+        row, col = divmod(i, columns)
+        country = (u'COU', next(codes), None, (
+            minx + col * width,
+            miny + row * height,
+            minx + (col + 1) * width,
+            miny + (row + 1) * height))
+        divisions.append(country)
+        for province in children(u'PRO', country[1], country[3]):
+            divisions.append(province)
+            divisions.extend(children(u'REG', province[1], province[3]))
+    return divisions
+
+
+def division_polygon(bounds, vertices):
+    '''Return the polygon of the bounds, with `vertices` points per edge,
+    so that the cost of decoding and rasterizing it gets closer to the one
+    of real boundaries.'''
+    left, bottom, right, top = bounds
+    steps = numpy.linspace(0., 1., vertices, endpoint=False)
+    points = []
+    for (x0, y0), (x1, y1) in (((left, bottom), (left, top)),
+                               ((left, top), (right, top)),
+                               ((right, top), (right, bottom)),
+                               ((right, bottom), (left, bottom))):
+        points.extend(zip(x0 + (x1 - x0) * steps, y0 + (y1 - y0) * steps))
+    return Polygon(points)
+
+
+def populate_divisions(countries, split, vertices):
+    '''Replace the divisions of the datamart by the synthetic ones, stored
+    in EPSG:3857 like the real ones. Return the number of REG divisions.'''
+    DBSession.query(AdministrativeDivision).delete()
+    leveltypes = dict((level, AdminLevelType.get(level).id)
+                      for level in (u'COU', u'PRO', u'REG'))
+    project = pyproj.Proj(init='epsg:3857')
+
+    count = 0
+    for level, code, parent_code, bounds in division_grid(countries, split):
+        polygon = division_polygon(bounds, vertices)
+        xs, ys = project(*zip(*polygon.exterior.coords))
+        division = AdministrativeDivision(**{
+            'code': code,
+            'leveltype_id': leveltypes[level],
+            'name': u'{} {}'.format(level, code),
+            })
+        division.parent_code = parent_code
+        division.geom = from_shape(MultiPolygon([Polygon(zip(xs, ys))]),
+                                   3857)
+        DBSession.add(division)
+        if level == u'REG':
+            count += 1
+    DBSession.flush()
+    transaction.commit()
+    return count
+
+
+def write_layer(path, resolution, scale, seed):
+    '''Write a global synthetic layer of the given resolution, in degrees,
+    with values ranging from 0 to `scale`. The layer is written by bands of
+    rows, tiled like the prepared layers.'''
+    width = int(round(360. / resolution))
+    height = int(round(180. / resolution))
+    block_size = settings['processing']['block_size']
+    random = numpy.random.RandomState(seed)
+    kwargs = dict(
+        driver='GTiff',
+        width=width,
+        height=height,
+        count=1,
+        dtype=rasterio.float32,
+        crs={'init': 'epsg:4326'},
+        transform=Affine(resolution, 0., -180., 0., -resolution, 90.),
+        nodata=NODATA,
+        tiled=True,
+        blockxsize=block_size,
+        blockysize=block_size,
+        compress='deflate')
+    lons = numpy.radians(-180. + resolution * (numpy.arange(width) + 0.5))
+    with rasterio.open(path, 'w', **kwargs) as dst:
+        for row in range(0, height, block_size):
+            stop = min(row + block_size, height)
+            lats = numpy.radians(
+                90. - resolution * (numpy.arange(row, stop) + 0.5))
+            # smooth field in [0, 1] with some noise
+            data = (numpy.sin(lons * 9)[numpy.newaxis, :] +
+                    numpy.cos(lats * 12)[:, numpy.newaxis] + 2) / 4
+            data += random.uniform(-0.05, 0.05, data.shape)
+            data = (numpy.clip(data, 0, 1) * scale).astype(numpy.float32)
+            data[numpy.degrees(lats) < NODATA_LATITUDE, :] = NODATA
+            dst.write(data, 1, window=((row, stop), (0, width)))
+
+
+def populate_hazardset(resolution, hazardlevels=False):
+    '''Write the layers of a synthetic global EQ hazardset of the given
+    resolution and record them, with the hazard levels raster if asked.
+    Return the hazardset id.'''
+    hazardtype = HazardType.get(u'EQ')
+    unit, threshold = sorted(settings['hazard_types'][u'EQ']['thresholds']
+                             .items())[0]
+
+    hazardset = HazardSet()
+    hazardset.id = u'BENCH-{}'.format(resolution)
+    hazardset.hazardtype = hazardtype
+    hazardset.local = False
+    hazardset.data_lastupdated_date = datetime.datetime.now()
+    hazardset.metadata_lastupdated_date = datetime.datetime.now()
+    DBSession.add(hazardset)
+    if not os.path.exists(hazardset.path()):
+        os.makedirs(hazardset.path())
+
+    for seed, level in enumerate((u'HIG', u'MED', u'LOW')):
+        layer = Layer()
+        layer.title = u'{}-{}'.format(hazardset.id, RETURN_PERIODS[level])
+        layer.hazardlevel = HazardLevel.get(level)
+        layer.return_period = RETURN_PERIODS[level]
+        layer.hazardunit = unit
+        layer.data_lastupdated_date = datetime.datetime.now()
+        layer.metadata_lastupdated_date = datetime.datetime.now()
+        layer.geonode_id = (DBSession.query(func.max(Layer.geonode_id))
+                            .scalar() or 0) + 1
+        layer.download_url = u'file://{}'.format(layer.path())
+        layer.calculation_method_quality = 5
+        layer.scientific_quality = 1
+        layer.local = False
+        layer.downloaded = True
+        hazardset.layers.append(layer)
+        DBSession.flush()
+        print '  writing {}'.format(layer.path())
+        write_layer(layer.path(), resolution, threshold * SCALES[level],
+                    seed)
+
+    hazardset.complete = True
+    DBSession.flush()
+    hazardset_id = hazardset.id
+    if hazardlevels:
+        thresholds = settings['hazard_types'][u'EQ']['thresholds']
+        catalogue.load([hazardset_id])
+        try:
+            build_hazardlevels(hazardset, hazardset_layers(hazardset),
+                               thresholds)
+        finally:
+            catalogue.invalidate()
+    transaction.commit()
+    return hazardset_id
+
+
+def read_metrics(name):
+    '''Return the last metrics summary recorded for `name` in the metrics
+    file of the benchmark.'''
+    path = os.path.join(settings['data_path'],
+                        settings['processing']['metrics_file'])
+    summary = None
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['name'] == name:
+                summary = record
+    return summary
+
+
+def code_version():
+    '''Return the git commit of the code, if it is a git checkout.'''
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(__file__)).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def startup_times(count=3):
+    '''Return the best time, out of `count`, of a fresh interpreter
+    importing each entry point.'''
+    root = os.path.join(os.path.dirname(__file__), '..')
+    times = {}
+    for script in SCRIPTS:
+        command = [sys.executable, '-c',
+                   'import thinkhazard_processing.scripts.{}'.format(script)]
+        best = None
+        for i in range(count):
+            start = time.time()
+            subprocess.check_call(command, cwd=root)
+            duration = time.time() - start
+            best = duration if best is None else min(best, duration)
+        times[script] = best
+    return times
+
+
+def benchmark(resolutions, engines, countries, split, vertices,
+              hazardlevels=False, jobs=1):
+    '''Measure the startup times of the entry points, run the processing
+    of synthetic hazardsets of the given resolutions with each engine, then
+    the decision tree, and return the results.
+
+    The divisions and hazardsets of the database are replaced, so the
+    database must be a throwaway one. The layers and the metrics file are
+    written to the data path, which should be a temporary directory.'''
+    results = {
+        'date': datetime.datetime.now().isoformat(),
+        'version': code_version(),
+        'parameters': {
+            'resolutions': resolutions,
+            'engines': engines,
+            'countries': countries,
+            'split': split,
+            'vertices': vertices,
+            'hazardlevels': hazardlevels,
+            'jobs': jobs,
+            },
+        'runs': [],
+        'startup': startup_times(),
+        }
+
+    print 'Populating {} countries'.format(countries)
+    start = time.time()
+    divisions = populate_divisions(countries, split, vertices)
+    results['divisions'] = divisions
+    results['populate'] = time.time() - start
+    print '  {} REG divisions'.format(divisions)
+
+    default_engine = settings['processing']['engine']
+    try:
+        for resolution in resolutions:
+            print 'Populating hazardset of resolution {}'.format(resolution)
+            hazardset_id = populate_hazardset(resolution, hazardlevels)
+            for engine in engines:
+                print 'Processing {} with {} engine'.format(
+                    hazardset_id, engine)
+                settings['processing']['engine'] = engine
+                start = time.time()
+                # the inputs do not change from an engine to another
+                process(hazardset_id=hazardset_id, really_force=True,
+                        jobs=jobs)
+                results['runs'].append({
+                    'hazardset': hazardset_id,
+                    'resolution': resolution,
+                    'engine': engine,
+                    'duration': time.time() - start,
+                    'metrics': read_metrics(hazardset_id),
+                    })
+    finally:
+        settings['processing']['engine'] = default_engine
+
+    print 'Running the decision tree'
+    metrics.reset(u'decision_tree')
+    with metrics.stage('decision_tree'):
+        process_outputs()
+    results['decision_tree'] = metrics.write()
+    return results
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import tempfile
+import numpy
+
+from . import settings
+
+
+def mask_cache():
+    '''Return the cache of rasterized divisions configured in the settings,
+    or None if it is disabled.'''
+    max_size = settings['processing']['mask_cache_size']
+    if not max_size:
+        return None
+    path = os.path.join(settings['data_path'], 'cache', 'masks')
+    return MaskCache(path, max_size * 1024 * 1024)
+
+
+class MaskCache(object):
+    '''Persistent on-disk cache of rasterized divisions.
+
+    Entries are identified by keys built from everything the rasterization
+    depends on: the division id, a hash of its geometry, the transform
+    and the shape of the grid. A changed geometry thus never hits an old
+    entry, which is eventually evicted.
+
+    Masks are stored bit-packed, label rasters with the smallest unsigned
+    integer type able to hold them, both as .npy files. When the cache
+    grows over `max_size` bytes, the least recently used entries are
+    removed.'''
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # created meanwhile by another process
+                if not os.path.isdir(self.path):
+                    raise
+        self.size = sum(size for path, size, mtime in self._entries())
+
+    def key(self, *parts):
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    def get_mask(self, key, shape):
+        '''Return the mask stored for the key as an uint8 array of the given
+        shape, or None.'''
+        packed = self._load(key)
+        if packed is None:
+            return None
+        size = shape[0] * shape[1]
+        return numpy.unpackbits(packed)[:size].reshape(shape)
+
+    def put_mask(self, key, mask):
+        self._save(key, numpy.packbits(mask.astype(bool)))
+
+    def get_labels(self, key):
+        '''Return the label raster stored for the key as a read-only memory
+        mapped array, or None.'''
+        return self._load(key, mmap_mode='r')
+
+    def put_labels(self, key, labels):
+        maximum = labels.max() if labels.size else 0
+        for dtype in (numpy.uint8, numpy.uint16, numpy.uint32):
+            if maximum <= numpy.iinfo(dtype).max:
+                break
+        self._save(key, labels.astype(dtype))
+
+    def _filename(self, key):
+        return os.path.join(self.path, '{}.npy'.format(key))
+
+    def _load(self, key, mmap_mode=None):
+        filename = self._filename(key)
+        try:
+            array = numpy.load(filename, mmap_mode=mmap_mode)
+            # the modification time tracks the last use of the entry
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            # missing, evicted meanwhile or partially written
+            return None
+        return array
+
+    def _save(self, key, array):
+        # write to a temporary file then rename it, so that concurrent
+        # processes never read a partially written entry
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            numpy.save(f, array)
+        filename = self._filename(key)
+        try:
+            # the entry is replaced when it was written meanwhile by
+            # another process, or could not be loaded
+            replaced = os.path.getsize(filename)
+        except OSError:
+            replaced = 0
+        os.rename(tmp, filename)
+        self.size += os.path.getsize(filename) - replaced
+        if self.size > self.max_size:
+            self.evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def evict(self):
+        '''Remove the least recently used entries until the cache is 10%
+        under its maximum size.'''
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self.size = sum(size for path, size, mtime in entries)
+        target = self.max_size * 0.9
+        for path, size, mtime in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.size -= size
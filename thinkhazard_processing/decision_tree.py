@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+import transaction
+from sqlalchemy import (
+    and_,
+    bindparam,
+    exists,
+    func,
+    select,
+    )
+from sqlalchemy.orm import aliased
+from zope.sqlalchemy import mark_changed
+
+from thinkhazard_common.models import (
+    DBSession,
+    AdministrativeDivision,
+    AdminLevelType,
+    HazardLevel,
+    HazardType,
+    HazardCategory,
+    hazardcategory_administrativedivision_table,
+    )
+from .models import (
+    HazardSet,
+    Output,
+    OutputChange,
+    catalogue,
+    )
+
+
+def upscale_hazardcategories(changes=None):
+    '''Link the admin divisions with the highest HazardCategory among
+    their descendants, for each hazardtype.
+
+    The admin hierarchy is loaded once and walked in memory, so that any
+    depth is supported, not only REG -> PRO -> COU. The new links are
+    inserted in bulk.
+
+    When `changes`, a set of (admin id, hazardtype id) tuples, is given,
+    only the ancestors of these admin divisions are upscaled again for
+    these hazardtypes.'''
+    table = hazardcategory_administrativedivision_table
+
+    # parent of each admin division
+    divisions = DBSession.query(AdministrativeDivision.id,
+                                AdministrativeDivision.code,
+                                AdministrativeDivision.parent_code).all()
+    ids = dict((code, id) for id, code, parent_code in divisions)
+    parents = dict((id, ids.get(parent_code))
+                   for id, code, parent_code in divisions
+                   if parent_code is not None)
+
+    # hazardtype and hazardlevel order of each HazardCategory,
+    # the highest hazardlevel having the lowest order
+    orders = dict((hazardlevel.id, hazardlevel.order)
+                  for hazardlevel in catalogue.hazardlevels.values())
+    categories = dict(
+        (hazardcategory.id, (hazardcategory.hazardtype_id,
+                             orders[hazardcategory.hazardlevel_id]))
+        for hazardcategory in catalogue.hazardcategories.values())
+
+    links = DBSession.query(table.c.administrativedivision_id,
+                            table.c.hazardcategory_id)
+    targets = None
+    if changes is not None:
+        # the (ancestor, hazardtype) tuples to upscale again
+        targets = set()
+        for admin_id, hazardtype_id in changes:
+            ancestors = set()
+            parent_id = parents.get(admin_id)
+            while parent_id is not None and parent_id not in ancestors:
+                ancestors.add(parent_id)
+                targets.add((parent_id, hazardtype_id))
+                parent_id = parents.get(parent_id)
+        if len(targets) == 0:
+            return
+        delete_hazardcategories(targets)
+
+        # only the links of their descendants are needed
+        children = {}
+        for admin_id, parent_id in parents.iteritems():
+            children.setdefault(parent_id, []).append(admin_id)
+        descendants = set()
+        stack = list(set(admin_id for admin_id, hazardtype_id in targets))
+        while stack:
+            for child_id in children.get(stack.pop(), ()):
+                if child_id not in descendants:
+                    descendants.add(child_id)
+                    stack.append(child_id)
+        descendants = sorted(descendants)
+        links = [link for i in range(0, len(descendants), 1000)
+                 for link in links.filter(
+                     table.c.administrativedivision_id.in_(
+                         descendants[i:i + 1000]))]
+
+    links = list(links)
+    linked = set((admin_id, categories[hazardcategory_id][0])
+                 for admin_id, hazardcategory_id in links)
+
+    # for each link, walk up the hierarchy and keep
+    # the highest HazardCategory for each (ancestor, hazardtype)
+    upscaled = {}
+    for admin_id, hazardcategory_id in links:
+        hazardtype_id, order = categories[hazardcategory_id]
+        ancestors = set()
+        parent_id = parents.get(admin_id)
+        while parent_id is not None and parent_id not in ancestors:
+            ancestors.add(parent_id)
+            key = (parent_id, hazardtype_id)
+            if key not in linked and (targets is None or key in targets):
+                current = upscaled.get(key)
+                if current is None or order < categories[current][1]:
+                    upscaled[key] = hazardcategory_id
+            parent_id = parents.get(parent_id)
+
+    if upscaled:
+        DBSession.execute(table.insert(), [
+            {'administrativedivision_id': ancestor[0],
+             'hazardcategory_id': hazardcategory_id}
+            for ancestor, hazardcategory_id in upscaled.iteritems()])
+        mark_changed(DBSession())
+    print '[upscaling] {} admindivs inherit hazardcategories'.format(
+        len(set(ancestor[0] for ancestor in upscaled)))
+
+
+def delete_hazardcategories(targets):
+    '''Remove the links of the given (admin id, hazardtype id) tuples.'''
+    table = hazardcategory_administrativedivision_table
+    DBSession.execute(
+        table.delete().where(and_(
+            table.c.administrativedivision_id == bindparam('admin_id'),
+            table.c.hazardcategory_id.in_(
+                select([HazardCategory.id]).where(
+                    HazardCategory.hazardtype_id ==
+                    bindparam('hazardtype_id'))))),
+        [{'admin_id': admin_id, 'hazardtype_id': hazardtype_id}
+         for admin_id, hazardtype_id in targets])
+    mark_changed(DBSession())
+
+
+def process_outputs(summary=False, incremental=False, min_coverage=0):
+    '''Run the decision tree. In incremental mode, only the (admindiv,
+    hazardtype) tuples whose outputs changed since the last run (see
+    OutputChange) and their ancestors are computed again. Outputs with a
+    coverage ratio lower than `min_coverage` are ignored.'''
+    print "Decision Tree running..."
+    catalogue.load(hazardset_ids=[])
+    try:
+        _process_outputs(summary, incremental, min_coverage)
+    finally:
+        catalogue.invalidate()
+
+
+def _process_outputs(summary, incremental, min_coverage):
+    table = hazardcategory_administrativedivision_table
+    changed_hazardset = aliased(HazardSet)
+    changes = None
+    if incremental:
+        changes = set(
+            DBSession.query(OutputChange.admin_id,
+                            changed_hazardset.hazardtype_id)
+            .join(changed_hazardset, OutputChange.hazardset).distinct())
+        print '[decision tree] {} changed (admindiv, hazardtype) tuples' \
+            .format(len(changes))
+        if len(changes) == 0:
+            return
+        # remove the records of the changed tuples
+        DBSession.execute(table.delete().where(exists().where(and_(
+            OutputChange.admin_id == table.c.administrativedivision_id,
+            changed_hazardset.id == OutputChange.hazardset_id,
+            HazardCategory.id == table.c.hazardcategory_id,
+            HazardCategory.hazardtype_id ==
+            changed_hazardset.hazardtype_id))))
+    else:
+        # first of all, remove all records
+        # in the datamart table linking admin divs with hazard categories:
+        DBSession.execute(table.delete())
+    # identify the admin level for which we run the decision tree:
+    # (REG)ion aka admin level 2
+    dt_level = catalogue.adminleveltype(u'REG')
+    # for each unique (admindiv, hazardtype) tuple contained in the Output
+    # table, identify the most relevant HazardSet in the light of the
+    # criteria that we all agreed on (cf Decision Tree), and link the
+    # admindiv to the HazardCategory matching the hazardtype and the
+    # hazardset's hazardlevel, all of this in one single statement:
+    decisions = (
+        DBSession.query(Output.admin_id, HazardCategory.id)
+        .join(HazardSet, Output.hazardset)
+        .join(AdministrativeDivision, Output.administrativedivision)
+        .join(HazardCategory, and_(
+            HazardCategory.hazardtype_id == HazardSet.hazardtype_id,
+            HazardCategory.hazardlevel_id == Output.hazardlevel_id))
+        # the following should not be necessary in production
+        # because only the lowest admin levels should be inserted
+        # in the Output table:
+        .filter(AdministrativeDivision.leveltype_id == dt_level.id)
+        .filter(Output.coverage_ratio >= min_coverage)
+        .distinct(Output.admin_id, HazardSet.hazardtype_id)
+        .order_by(Output.admin_id,
+                  HazardSet.hazardtype_id,
+                  HazardSet.calculation_method_quality.desc(),
+                  HazardSet.scientific_quality.desc(),
+                  HazardSet.local.desc(),
+                  HazardSet.data_lastupdated_date.desc())
+    )
+    if incremental:
+        decisions = decisions.filter(exists().where(and_(
+            OutputChange.admin_id == Output.admin_id,
+            changed_hazardset.id == OutputChange.hazardset_id,
+            changed_hazardset.hazardtype_id == HazardSet.hazardtype_id)))
+    DBSession.execute(table.insert().from_select(
+        [table.c.administrativedivision_id, table.c.hazardcategory_id],
+        decisions.statement))
+    mark_changed(DBSession())
+
+    # UpScaling level2 (REG)ion -> level1 (PRO)vince -> level0 (COU)ntry
+    upscale_hazardcategories(changes)
+
+    # the changes are now taken into account
+    DBSession.query(OutputChange).delete()
+
+    if summary:
+        print_decision_tree_summary()
+
+    transaction.commit()
+
+
+def print_decision_tree_summary():
+    table = hazardcategory_administrativedivision_table
+    rows = DBSession.query(AdminLevelType.mnemonic,
+                           HazardType.mnemonic,
+                           HazardLevel.mnemonic,
+                           func.count()) \
+        .select_from(table) \
+        .join(AdministrativeDivision,
+              AdministrativeDivision.id == table.c.administrativedivision_id) \
+        .join(AdminLevelType) \
+        .join(HazardCategory,
+              HazardCategory.id == table.c.hazardcategory_id) \
+        .join(HazardType) \
+        .join(HazardLevel) \
+        .group_by(AdminLevelType.mnemonic,
+                  HazardType.mnemonic,
+                  HazardLevel.mnemonic) \
+        .order_by(AdminLevelType.mnemonic,
+                  HazardType.mnemonic,
+                  HazardLevel.mnemonic)
+    for adminlevel, hazardtype, hazardlevel, count in rows:
+        print '[decision tree] {} {} admindivs get hazardlevel {} for {}' \
+            .format(count, adminlevel, hazardlevel, hazardtype)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import traceback
+import transaction
+import requests
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import (
+    and_,
+    bindparam,
+    exists,
+    func,
+    select,
+    )
+from zope.sqlalchemy import mark_changed
+
+from thinkhazard_common.models import DBSession
+from .models import (
+    HazardSet,
+    Layer,
+    )
+from . import settings
+
+
+# size of the chunks written to the disk, in bytes
+CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+def download(hazardset_id=None, force=False, jobs=None):
+    '''Download the layers which are not downloaded yet, or all of them if
+    `force` is True, with `jobs` concurrent downloads sharing a pool of
+    HTTP connections. The downloaded layers, then the hazardsets whose
+    three layers are downloaded, are updated in bulk. Returns the list of
+    the names of the layers which failed.'''
+    if jobs is None:
+        jobs = settings['download']['jobs']
+    layers = DBSession.query(Layer)
+    if hazardset_id is not None:
+        layers = layers.filter(Layer.hazardset_id == hazardset_id)
+    if not force:
+        layers = layers.filter(Layer.downloaded.is_(False))
+    layers = layers.order_by(Layer.hazardset_id, Layer.return_period).all()
+    if len(layers) == 0:
+        print 'No layers to download'
+        return []
+
+    # the threads only get plain values, the session is not thread safe
+    tasks = [((layer.hazardset_id, layer.hazardlevel_id), layer.name(),
+              layer.download_url, layer.path())
+             for layer in layers]
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=jobs,
+                                            pool_maxsize=jobs)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    done = []
+    failed = []
+    pool = ThreadPool(jobs)
+    try:
+        results = pool.imap_unordered(
+            lambda task: _download_task(session, task), tasks)
+        for key, name, error in results:
+            if error is None:
+                print '[download] {} downloaded'.format(name)
+                done.append(key)
+            else:
+                print '[download] {} failed:\n{}'.format(name, error)
+                failed.append(name)
+    finally:
+        pool.close()
+        pool.join()
+        session.close()
+
+    if done:
+        mark_downloaded(done)
+    print '[download] {} layers downloaded, {} failed'.format(
+        len(done), len(failed))
+    return failed
+
+
+def _download_task(session, task):
+    key, name, url, path = task
+    try:
+        download_file(session, url, path)
+    except Exception:
+        return key, name, traceback.format_exc()
+    return key, name, None
+
+
+def download_file(session, url, path):
+    '''Download the file at `url` to `path`.
+
+    The data is written to a partial file next to `path`. An interrupted
+    download is resumed with a Range request, from the size of the partial
+    file. The size of the file is validated against the one announced by
+    the server, then it is renamed to `path`, so that a partially
+    downloaded file is never used.'''
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # created meanwhile by another thread
+            if not os.path.isdir(directory):
+                raise
+    partial = '{}.part'.format(path)
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+
+    headers = {}
+    if offset > 0:
+        headers['Range'] = 'bytes={}-'.format(offset)
+    timeout = settings['download']['timeout']
+    response = session.get(url, headers=headers, stream=True,
+                           timeout=timeout)
+    try:
+        if response.status_code == 416:
+            # nothing left to download
+            size = content_range_size(response)
+            if size != offset:
+                raise DownloadException(
+                    'Range of {} bytes not satisfiable, {} bytes on the '
+                    'server'.format(offset, size))
+        else:
+            response.raise_for_status()
+            if response.status_code != 206:
+                # the server ignored the range, start over
+                offset = 0
+                size = response.headers.get('Content-Length')
+                size = int(size) if size is not None else None
+            else:
+                size = content_range_size(response)
+            with open(partial, 'ab' if offset > 0 else 'wb') as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+    finally:
+        response.close()
+
+    actual = os.path.getsize(partial)
+    if size is not None and actual != size:
+        if actual > size:
+            # can not be resumed
+            os.remove(partial)
+        raise DownloadException('Downloaded {} bytes of {}, expected {}'
+                                .format(actual, url, size))
+    os.rename(partial, path)
+
+
+def content_range_size(response):
+    '''Return the complete size of the file given by the Content-Range
+    header of the response, or None.'''
+    match = re.match(r'bytes (?:\d+-\d+|\*)/(\d+)',
+                     response.headers.get('Content-Range', ''))
+    return int(match.group(1)) if match else None
+
+
+def mark_downloaded(keys):
+    '''Set the layers of the given (hazardset id, hazardlevel id) keys as
+    downloaded, then the hazardsets whose three layers are downloaded as
+    complete, and commit.'''
+    table = Layer.__table__
+    DBSession.execute(
+        table.update()
+        .where(and_(table.c.hazardset_id == bindparam('_hazardset_id'),
+                    table.c.hazardlevel_id == bindparam('_hazardlevel_id')))
+        .values(downloaded=True),
+        [{'_hazardset_id': hazardset_id, '_hazardlevel_id': hazardlevel_id}
+         for hazardset_id, hazardlevel_id in keys])
+
+    hazardsets = HazardSet.__table__
+    count = select([func.count()]) \
+        .where(table.c.hazardset_id == hazardsets.c.id) \
+        .as_scalar()
+    completed = DBSession.execute(
+        hazardsets.update()
+        .where(hazardsets.c.id.in_(set(key[0] for key in keys)))
+        .where(hazardsets.c.complete.is_(False))
+        .where(count == 3)
+        .where(~exists().where(and_(
+            table.c.hazardset_id == hazardsets.c.id,
+            table.c.downloaded.is_(False))))
+        .values(complete=True)).rowcount
+    mark_changed(DBSession())
+    transaction.commit()
+    print '[download] {} hazardsets complete'.format(completed)
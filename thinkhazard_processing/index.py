@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+import transaction
+from shapely import wkb
+from shapely.geometry import box
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+from sqlalchemy import (
+    Integer,
+    and_,
+    bindparam,
+    exists,
+    func,
+    select,
+    )
+from sqlalchemy.dialects.postgresql import ARRAY
+from zope.sqlalchemy import mark_changed
+
+from thinkhazard_common.models import (
+    DBSession,
+    AdministrativeDivision,
+    )
+from .models import (
+    DivisionGeometry,
+    catalogue,
+    )
+from .metrics import metrics
+
+
+def refresh_division_geometries():
+    '''Bring the table of the geometries of the REG divisions in EPSG:4326
+    up to date with the datamart, and commit.
+
+    The source geometries are compared by hash, so that only the new and
+    the changed ones are transformed. Return the number of geometries
+    transformed.'''
+    table = DivisionGeometry.__table__
+    source = AdministrativeDivision.__table__
+    source_hash = func.md5(func.ST_AsBinary(source.c.geom))
+    processed = and_(
+        source.c.leveltype_id == catalogue.adminleveltype(u'REG').id,
+        source.c.geom.isnot(None))
+
+    with metrics.stage('reproject'):
+        # divisions removed, without geometry or of another level now
+        DBSession.execute(table.delete().where(~exists().where(and_(
+            source.c.id == table.c.admin_id,
+            processed))))
+
+        changed = DBSession.execute(
+            table.update()
+            .where(source.c.id == table.c.admin_id)
+            .where(table.c.source_hash != source_hash)
+            .values(source_hash=source_hash,
+                    geom=func.ST_Transform(source.c.geom, 4326),
+                    minx=None)).rowcount
+
+        added = DBSession.execute(table.insert().from_select(
+            ['admin_id', 'source_hash', 'geom'],
+            select([source.c.id,
+                    source_hash,
+                    func.ST_Transform(source.c.geom, 4326)])
+            .where(processed)
+            .where(~exists().where(table.c.admin_id == source.c.id))
+            )).rowcount
+
+        geom = table.c.geom
+        DBSession.execute(
+            table.update()
+            .where(table.c.minx.is_(None))
+            .values(minx=func.ST_XMin(geom),
+                    miny=func.ST_YMin(geom),
+                    maxx=func.ST_XMax(geom),
+                    maxy=func.ST_YMax(geom)))
+        mark_changed(DBSession())
+        transaction.commit()
+
+    print '[geometries] {} division geometries transformed'.format(
+        changed + added)
+    return changed + added
+
+
+def geometries_signature():
+    '''Return a signature of the source geometries of the divisions, which
+    changes when any of them changes.'''
+    return DBSession.execute(
+        "SELECT md5(string_agg(source_hash, ',' ORDER BY admin_id)) "
+        "FROM processing.division_geometry").scalar()
+
+
+def query_geometries(admin_ids, batch_size=1000):
+    '''Yield the (admin id, geometry in EPSG:4326) tuples of the divisions
+    of the given sorted ids.
+
+    Only the ids and the WKB of the geometries are selected, in a single
+    statement whose rows are streamed from a server-side cursor. They are
+    fetched and decoded by batches, so that the memory used does not depend
+    on the number of divisions.'''
+    if len(admin_ids) == 0:
+        return
+    table = DivisionGeometry.__table__
+    with metrics.stage('query'):
+        rows = DBSession.connection() \
+            .execution_options(stream_results=True) \
+            .execute(
+                select([table.c.admin_id, func.ST_AsBinary(table.c.geom)])
+                .where(table.c.admin_id == func.any(
+                    bindparam('admin_ids', admin_ids,
+                              type_=ARRAY(Integer))))
+                .order_by(table.c.admin_id))
+    try:
+        while True:
+            with metrics.stage('query'):
+                batch = rows.fetchmany(batch_size)
+            if not batch:
+                break
+            with metrics.stage('decode'):
+                divisions = [(admin_id, wkb.loads(bytes(geometry)))
+                             for admin_id, geometry in batch]
+            for division in divisions:
+                yield division
+    finally:
+        rows.close()
+
+
+class DivisionIndex(object):
+    '''Run-scoped spatial index of the bounding boxes of the divisions
+    which are processed, those of the REG admin level.
+
+    The bounding boxes are read from the table of the geometries in
+    EPSG:4326, which is refreshed when the index is loaded.
+
+    The candidate divisions of a footprint are selected with an STRtree.
+    They are kept by footprint, so that the hazardsets sharing a footprint,
+    like the global ones, reuse them. The index must be invalidated between
+    runs.'''
+
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        self.ids = None
+        self.boxes = None
+        self.indices = None
+        self.tree = None
+        self.signature = None
+        self.candidates_by_footprint = {}
+
+    def load(self):
+        self.invalidate()
+        refresh_division_geometries()
+        self.signature = geometries_signature()
+        rows = DBSession.query(DivisionGeometry.admin_id,
+                               DivisionGeometry.minx,
+                               DivisionGeometry.miny,
+                               DivisionGeometry.maxx,
+                               DivisionGeometry.maxy) \
+            .order_by(DivisionGeometry.admin_id) \
+            .all()
+
+        self.ids = [row[0] for row in rows]
+        self.boxes = [box(*row[1:]) for row in rows]
+        if len(self.boxes) > 0:
+            self.tree = STRtree(self.boxes)
+        # the tree returns the boxes, not their index
+        self.indices = dict((id(bbox), i) for i, bbox in enumerate(self.boxes))
+
+    def candidates(self, footprint):
+        '''Return the sorted list of the ids of the divisions whose bounding
+        box intersects the footprint, and the set of those whose bounding
+        box is within the footprint. The latter intersect the footprint for
+        sure, they do not need an exact intersection test.'''
+        key = footprint.wkb
+        if key in self.candidates_by_footprint:
+            return self.candidates_by_footprint[key]
+        if self.ids is None:
+            self.load()
+
+        admin_ids = []
+        inside = set()
+        if self.tree is not None:
+            prepared = prep(footprint)
+            for bbox in self.tree.query(footprint):
+                if not prepared.intersects(bbox):
+                    continue
+                admin_id = self.ids[self.indices[id(bbox)]]
+                admin_ids.append(admin_id)
+                if prepared.covers(bbox):
+                    inside.add(admin_id)
+        admin_ids.sort()
+
+        self.candidates_by_footprint[key] = (admin_ids, inside)
+        return admin_ids, inside
+
+
+division_index = DivisionIndex()
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import tempfile
+import numpy
+import rasterio
+from contextlib import contextmanager
+
+from . import settings
+from .metrics import metrics
+
+
+# flags of the pixels of the hazard levels rasters, telling whether the
+# layer of each level has data (valid) and a value above the threshold
+# (positive) in the pixel
+VALID_FLAGS = {u'HIG': 1, u'MED': 2, u'LOW': 4}
+POSITIVE_FLAGS = {u'HIG': 8, u'MED': 16, u'LOW': 32}
+
+# to be increased when the content of the hazard levels rasters changes
+VERSION = 1
+
+
+def level_thresholds(layers, thresholds):
+    '''Return the thresholds of the three layers per level, given the
+    thresholds of the hazard type per unit.'''
+    return dict((level, thresholds[layers[level].hazardunit])
+                for level in (u'HIG', u'MED', u'LOW'))
+
+
+def layers_flags(readers, thresholds, window):
+    '''Compute the flags of the pixels of the window from the three layers,
+    which must share the same grid, given their thresholds per level.
+
+    Besides the flags, at most the data and the mask of a layer and two
+    arrays of booleans are held at a time, see zonal.stream_windows.'''
+    flags = None
+    for level in (u'HIG', u'MED', u'LOW'):
+        with metrics.stage('read'):
+            data = readers[level].read(1, window=window, masked=True)
+        with metrics.stage('threshold'):
+            valid = ~numpy.ma.getmaskarray(data)
+            positive = numpy.ma.getdata(data) > thresholds[level]
+            positive &= valid
+        del data
+        if flags is None:
+            flags = numpy.zeros(valid.shape, dtype=numpy.uint8)
+        numpy.bitwise_or(flags, VALID_FLAGS[level], out=flags, where=valid)
+        numpy.bitwise_or(flags, POSITIVE_FLAGS[level], out=flags,
+                         where=positive)
+        del valid, positive
+    return flags
+
+
+def read_flags(readers, thresholds, window, levels=None):
+    '''Return the flags of the pixels of the window, read from the hazard
+    levels raster `levels` if any, computed from the layers otherwise.'''
+    if levels is not None:
+        with metrics.stage('read'):
+            return levels.read(1, window=window)
+    return layers_flags(readers, thresholds, window)
+
+
+def split_flags(flags):
+    '''Return the valid and positive arrays of booleans of each level,
+    as expected by zonal.hazardlevel_codes, for an array of flags.'''
+    valid = {}
+    positive = {}
+    for level in (u'HIG', u'MED', u'LOW'):
+        valid[level] = (flags & VALID_FLAGS[level]) != 0
+        positive[level] = (flags & POSITIVE_FLAGS[level]) != 0
+    return valid, positive
+
+
+def same_grid(readers):
+    grids = set((tuple(src.shape), tuple(src.transform))
+                for src in readers.values())
+    return len(grids) == 1
+
+
+def signature(layers, thresholds):
+    '''Return the signature of what the hazard levels raster of a hazardset
+    depends on: its layer files and their thresholds.'''
+    parts = [VERSION]
+    for level in (u'HIG', u'MED', u'LOW'):
+        path = layers[level].processing_path()
+        size = mtime = None
+        if os.path.exists(path):
+            stat = os.stat(path)
+            size, mtime = stat.st_size, stat.st_mtime
+        parts.append((level, path, size, mtime,
+                      thresholds[layers[level].hazardunit]))
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def build_hazardlevels(hazardset, layers, thresholds, force=False):
+    '''Write the hazard levels raster of the hazardset, unless it is up to
+    date or its layers do not share the same grid. Return True if it has
+    been written.'''
+    path = hazardset.hazardlevels_path()
+    current = signature(layers, thresholds)
+    if not force and hazardlevels_signature(path) == current:
+        return False
+
+    readers = {}
+    try:
+        for level in (u'HIG', u'MED', u'LOW'):
+            readers[level] = rasterio.open(layers[level].processing_path())
+        if not same_grid(readers):
+            print '  layers do not share the same grid, ' \
+                'no hazard levels raster'
+            return False
+        per_level = level_thresholds(layers, thresholds)
+
+        src = readers[u'HIG']
+        height, width = src.shape
+        block_size = settings['processing']['block_size']
+        kwargs = src.meta.copy()
+        kwargs.update(
+            driver='GTiff',
+            count=1,
+            dtype=rasterio.uint8,
+            nodata=None,
+            tiled=True,
+            blockxsize=block_size,
+            blockysize=block_size,
+            compress='deflate')
+
+        # written to a temporary file then renamed, see prepare_layer
+        fd, tmp = tempfile.mkstemp(suffix='.tif', dir=hazardset.path())
+        os.close(fd)
+        try:
+            with rasterio.open(tmp, 'w', **kwargs) as dst:
+                for row in range(0, height, block_size):
+                    window = ((row, min(row + block_size, height)),
+                              (0, width))
+                    dst.write(layers_flags(readers, per_level, window),
+                              1, window=window)
+                dst.update_tags(signature=current)
+            os.rename(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+    finally:
+        for reader in readers.values():
+            reader.close()
+    return True
+
+
+def hazardlevels_signature(path):
+    if not os.path.exists(path):
+        return None
+    with rasterio.open(path) as src:
+        return src.tags().get('signature')
+
+
+@contextmanager
+def open_hazardlevels(hazardset, layers, thresholds):
+    '''Open the hazard levels raster of the hazardset if it is up to date,
+    yield None otherwise.'''
+    path = hazardset.hazardlevels_path()
+    if not os.path.exists(path):
+        yield None
+        return
+    with rasterio.open(path) as src:
+        if src.tags().get('signature') != signature(layers, thresholds):
+            print '  hazard levels raster is outdated, reading the layers'
+            yield None
+        else:
+            yield src
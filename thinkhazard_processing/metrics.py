@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import array
+import heapq
+import cProfile
+import datetime
+from contextlib import contextmanager
+
+from . import settings
+
+
+# number of the slowest divisions reported
+SLOWEST_COUNT = 10
+
+
+class Metrics(object):
+    '''Run-scoped timings of the stages of the processing of a hazardset:
+    query, decode, reproject, read, threshold, rasterize, reduce and write.
+
+    The durations of each stage are recorded as they come, in compact
+    arrays, and so are those of the divisions processed one at a time by
+    the window engines, of which only the slowest ones are kept.
+
+    The metrics must be reset before each hazardset, and written once it
+    is processed: a summary is then appended as a JSON line to the file of
+    the processing.metrics_file setting.'''
+
+    def __init__(self):
+        self.reset(None)
+
+    def reset(self, name):
+        self.name = name
+        self.start = time.time()
+        self.durations = {}
+        self.slowest = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, duration):
+        if name not in self.durations:
+            self.durations[name] = array.array('d')
+        self.durations[name].append(duration)
+
+    def division(self, admin_id, duration):
+        if len(self.slowest) < SLOWEST_COUNT:
+            heapq.heappush(self.slowest, (duration, admin_id))
+        elif duration > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (duration, admin_id))
+
+    def state(self):
+        '''Return the recorded durations in a picklable form, to be merged
+        in the metrics of another process.'''
+        return (dict((name, durations.tolist())
+                     for name, durations in self.durations.items()),
+                list(self.slowest))
+
+    def merge(self, state):
+        durations, slowest = state
+        for name, values in durations.items():
+            if name not in self.durations:
+                self.durations[name] = array.array('d')
+            self.durations[name].extend(values)
+        for duration, admin_id in slowest:
+            self.division(admin_id, duration)
+
+    def summary(self, **extra):
+        '''Return the counts, totals and percentiles of the durations of
+        each stage, and the slowest divisions, in seconds.'''
+        # not needed by the entry points which do not touch rasters
+        import numpy
+        stages = {}
+        for name, durations in sorted(self.durations.items()):
+            values = numpy.array(durations, dtype=numpy.float64)
+            p50, p90, p99 = numpy.percentile(values, [50, 90, 99])
+            stages[name] = {
+                'count': len(values),
+                'total': round(values.sum(), 6),
+                'p50': round(p50, 6),
+                'p90': round(p90, 6),
+                'p99': round(p99, 6),
+                'max': round(values.max(), 6),
+                }
+        summary = {
+            'name': self.name,
+            'date': datetime.datetime.now().isoformat(),
+            'duration': round(time.time() - self.start, 6),
+            'stages': stages,
+            'slowest': [{'admin_id': admin_id, 'duration': round(duration, 6)}
+                        for duration, admin_id in sorted(self.slowest,
+                                                         reverse=True)],
+            }
+        summary.update(extra)
+        return summary
+
+    def write(self, **extra):
+        '''Print the totals of the stages and append the summary to the
+        metrics file, if any. Extra values, like the number of divisions,
+        are added to the summary.'''
+        summary = self.summary(**extra)
+        for name, stage in sorted(summary['stages'].items()):
+            print '  [metrics] {}: {} calls in {:.3f}s'.format(
+                name, stage['count'], stage['total'])
+
+        filename = settings['processing']['metrics_file']
+        if not filename:
+            return summary
+        path = os.path.join(settings['data_path'], filename)
+        # a single write per line, the processes processing hazardsets in
+        # parallel append to the same file
+        with open(path, 'a') as f:
+            f.write(json.dumps(summary, sort_keys=True) + '\n')
+        return summary
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def profile(path=None):
+    '''Profile the enclosed code with cProfile and dump the statistics to
+    `path`, for pstats or snakeviz, unless `path` is None. Only the current
+    process is profiled, not the workers of the --jobs option.'''
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print 'Profile written to {}'.format(path)
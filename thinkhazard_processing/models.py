@@ -5,15 +5,21 @@ from sqlalchemy import (
     ForeignKey,
     Boolean,
     Date,
+    DateTime,
+    Float,
     Integer,
     String,
     )
 from sqlalchemy.orm import relationship
+from geoalchemy2 import Geometry
 
 from thinkhazard_common.models import (
     DBSession,
     Base,
+    AdminLevelType,
+    HazardCategory,
     HazardLevel,
+    HazardType,
     )
 
 from . import settings
@@ -58,6 +64,8 @@ class HazardSet(Base):
     complete = Column(Boolean, nullable=False, default=False)
     # finally it is processed:
     processed = Column(Boolean, nullable=False, default=False)
+    # fingerprint of the inputs of the last processing, see processing.py
+    fingerprint = Column(String)
 
     hazardtype = relationship('HazardType', backref="hazardsets")
 
@@ -66,12 +74,12 @@ class HazardSet(Base):
                             'hazardsets',
                             self.id)
 
+    def hazardlevels_path(self):
+        # see levels.py
+        return os.path.join(self.path(), 'hazardlevels.tif')
+
     def layerByLevel(self, level):
-        hazardlevel = HazardLevel.get(level)
-        return DBSession.query(Layer) \
-            .filter(Layer.hazardset_id == self.id) \
-            .filter(Layer.hazardlevel_id == hazardlevel.id) \
-            .one_or_none()
+        return catalogue.layer(self.id, level)
 
 
 class Layer(Base):
@@ -114,6 +122,9 @@ class Layer(Base):
     # "downloaded" is set to true
     # when the geotiff file has been downloaded
     downloaded = Column(Boolean, nullable=False, default=False)
+    # path of the tiled and compressed copy of the geotiff file,
+    # see prepare.py
+    prepared_path = Column(String)
 
     hazardset = relationship('HazardSet', backref='layers')
     hazardlevel = relationship('HazardLevel')
@@ -127,6 +138,17 @@ class Layer(Base):
                             self.hazardset_id,
                             '{}.tif'.format(self.return_period))
 
+    def processing_path(self):
+        '''Return the path of the file to process, the prepared one if it
+        is up to date with the downloaded one.'''
+        if self.prepared_path is not None and \
+                os.path.exists(self.prepared_path):
+            if not os.path.exists(self.path()) or \
+                    os.path.getmtime(self.prepared_path) >= \
+                    os.path.getmtime(self.path()):
+                return self.prepared_path
+        return self.path()
+
 
 class Output(Base):
     __tablename__ = 'output'
@@ -153,3 +175,165 @@ class Output(Base):
     hazardset = relationship('HazardSet')
     administrativedivision = relationship('AdministrativeDivision')
     hazardlevel = relationship('HazardLevel')
+
+
+class OutputChange(Base):
+    __tablename__ = 'output_change'
+    __table_args__ = {u'schema': 'processing'}
+    # the outputs of a hazardset have changed for an administrative division
+    # since the last run of the decision tree, that is:
+    #  * the hazardset has been (re)processed
+    #  * the administrative division had or has an output from it
+    hazardset_id = Column(String,
+                          ForeignKey('processing.hazardset.id'),
+                          primary_key=True)
+    admin_id = Column(Integer,
+                      ForeignKey('datamart.administrativedivision.id'),
+                      primary_key=True)
+
+    hazardset = relationship('HazardSet')
+
+
+class OutputStaging(Base):
+    __tablename__ = 'output_staging'
+    __table_args__ = {u'schema': 'processing'}
+    # results of a hazardset being processed, committed by chunks,
+    # they replace its outputs at once when the processing completes
+    hazardset_id = Column(String,
+                          ForeignKey('processing.hazardset.id'),
+                          primary_key=True)
+    admin_id = Column(Integer,
+                      ForeignKey('datamart.administrativedivision.id',
+                                 ondelete='CASCADE'),
+                      primary_key=True)
+    # both are null for divisions which are not covered by the hazardset
+    coverage_ratio = Column(Integer)
+    hazardlevel_id = Column(Integer,
+                            ForeignKey('datamart.enum_hazardlevel.id'))
+
+
+class HazardSetProgress(Base):
+    __tablename__ = 'hazardset_progress'
+    __table_args__ = {u'schema': 'processing'}
+    # progress of a hazardset being processed
+    hazardset_id = Column(String,
+                          ForeignKey('processing.hazardset.id'),
+                          primary_key=True)
+    # signature of the inputs of the processing,
+    # the staged results are discarded when it changes
+    signature = Column(String, nullable=False)
+    # number of divisions processed so far, out of total
+    processed = Column(Integer, nullable=False, default=0)
+    total = Column(Integer, nullable=False)
+    # date of the last checkpoint
+    updated = Column(DateTime)
+
+
+class DivisionGeometry(Base):
+    __tablename__ = 'division_geometry'
+    __table_args__ = {u'schema': 'processing'}
+    # the geometry of a processed administrative division in EPSG:4326,
+    # see index.refresh_division_geometries
+    admin_id = Column(Integer,
+                      ForeignKey('datamart.administrativedivision.id',
+                                 ondelete='CASCADE'),
+                      primary_key=True)
+    # md5 of the source geometry (in EPSG:3857) that was transformed,
+    # to know when it has to be transformed again
+    source_hash = Column(String, nullable=False)
+    # geoalchemy2 creates a GiST index on the geometry
+    geom = Column(Geometry(srid=4326), nullable=False)
+    # bounding box of the geometry
+    minx = Column(Float)
+    miny = Column(Float)
+    maxx = Column(Float)
+    maxy = Column(Float)
+
+
+class Catalogue(object):
+    '''Run-scoped in-memory catalogue of the hazard levels, hazard types,
+    hazard categories, admin level types and layers.
+
+    They are loaded with a few eager queries, then resolved from
+    dictionaries. The objects are detached from the session, so that they
+    are not expired by the commits of the run, which means that the
+    catalogue must be invalidated between runs.'''
+
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        self.hazardlevels = None
+        self.hazardtypes = None
+        self.hazardcategories = None
+        self.adminleveltypes = None
+        self.layers = {}
+
+    def load(self, hazardset_ids=None):
+        '''Load the enumerations and the layers of the given hazardsets,
+        or of all the hazardsets if None.'''
+        self.invalidate()
+        self.load_enumerations()
+        if hazardset_ids is None or len(hazardset_ids) > 0:
+            self.load_layers(hazardset_ids)
+
+    def load_enumerations(self):
+        self.hazardlevels = dict(
+            (hazardlevel.mnemonic, hazardlevel)
+            for hazardlevel in self._detach(DBSession.query(HazardLevel)))
+        self.hazardtypes = dict(
+            (hazardtype.mnemonic, hazardtype)
+            for hazardtype in self._detach(DBSession.query(HazardType)))
+        self.hazardcategories = dict(
+            ((hazardcategory.hazardtype_id, hazardcategory.hazardlevel_id),
+             hazardcategory)
+            for hazardcategory in self._detach(
+                DBSession.query(HazardCategory)))
+        self.adminleveltypes = dict(
+            (adminleveltype.mnemonic, adminleveltype)
+            for adminleveltype in self._detach(
+                DBSession.query(AdminLevelType)))
+
+    def load_layers(self, hazardset_ids=None):
+        layers = DBSession.query(Layer)
+        if hazardset_ids is not None:
+            layers = layers.filter(Layer.hazardset_id.in_(hazardset_ids))
+        for layer in self._detach(layers):
+            self.layers[(layer.hazardset_id, layer.hazardlevel_id)] = layer
+
+    def _detach(self, query):
+        objects = query.all()
+        for obj in objects:
+            DBSession.expunge(obj)
+        return objects
+
+    def _enumerations(self):
+        if self.hazardlevels is None:
+            self.load_enumerations()
+
+    def hazardlevel(self, mnemonic):
+        self._enumerations()
+        return self.hazardlevels[mnemonic]
+
+    def hazardtype(self, mnemonic):
+        self._enumerations()
+        return self.hazardtypes[mnemonic]
+
+    def hazardcategory(self, hazardtype_id, hazardlevel_id):
+        self._enumerations()
+        return self.hazardcategories.get((hazardtype_id, hazardlevel_id))
+
+    def adminleveltype(self, mnemonic):
+        self._enumerations()
+        return self.adminleveltypes[mnemonic]
+
+    def layer(self, hazardset_id, level):
+        '''Return the layer of the hazardset for the given hazard level
+        mnemonic, or None.'''
+        key = (hazardset_id, self.hazardlevel(level).id)
+        if key not in self.layers:
+            self.load_layers([hazardset_id])
+        return self.layers.get(key)
+
+
+catalogue = Catalogue()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import transaction
+import rasterio
+from rasterio.enums import Resampling
+
+from thinkhazard_common.models import DBSession
+from .models import (
+    HazardSet,
+    Layer,
+    catalogue,
+    )
+from .levels import build_hazardlevels
+from .processing import hazardset_layers
+from . import settings
+
+
+def prepare(hazardset_id=None, force=False):
+    '''Prepare the layers, then the hazard levels rasters of the complete
+    hazardsets.'''
+    with rasterio.drivers():
+        prepare_layers(hazardset_id, force)
+        prepare_hazardsets(hazardset_id, force)
+
+
+def prepare_layers(hazardset_id=None, force=False):
+    '''Rewrite the downloaded layers as internally tiled and compressed
+    GeoTIFFs with overviews, and record their path on the layers. Layers
+    whose prepared copy is up to date are skipped, unless `force` is True,
+    the other ones are prepared again, e.g. after a new download.'''
+    layers = DBSession.query(Layer) \
+        .filter(Layer.downloaded.is_(True))
+    if hazardset_id is not None:
+        layers = layers.filter(Layer.hazardset_id == hazardset_id)
+    layers = layers.order_by(Layer.hazardset_id, Layer.return_period).all()
+    if not force:
+        # see Layer.processing_path
+        layers = [layer for layer in layers
+                  if layer.processing_path() != layer.prepared_path]
+    if len(layers) == 0:
+        print 'No layers to prepare'
+        return
+
+    for layer in layers:
+        print layer.name()
+        layer.prepared_path = prepare_layer(layer)
+        transaction.commit()
+
+
+def prepare_hazardsets(hazardset_id=None, force=False):
+    '''Write the hazard levels rasters of the complete hazardsets (see
+    levels.py) whose layers or thresholds changed, or all of them if
+    `force` is True.'''
+    hazardsets = DBSession.query(HazardSet) \
+        .filter(HazardSet.complete.is_(True))
+    if hazardset_id is not None:
+        hazardsets = hazardsets.filter(HazardSet.id == hazardset_id)
+    hazardsets = hazardsets.order_by(HazardSet.id).all()
+
+    catalogue.load([hazardset.id for hazardset in hazardsets])
+    try:
+        for hazardset in hazardsets:
+            thresholds = settings['hazard_types'][
+                hazardset.hazardtype.mnemonic]['thresholds']
+            if build_hazardlevels(hazardset, hazardset_layers(hazardset),
+                                  thresholds, force):
+                print '{} hazard levels raster written'.format(hazardset.id)
+    finally:
+        catalogue.invalidate()
+
+
+def prepare_layer(layer):
+    '''Write the tiled copy of the layer next to the downloaded file, and
+    return its path.
+
+    The processing reads the full resolution, the overviews are built for
+    the previews of the layers. They are resampled with the nearest
+    neighbour, so that they hold values of the layer, not averages which
+    would not compare to the thresholds.'''
+    path = layer.path()
+    prepared_path = '{}.tiled.tif'.format(os.path.splitext(path)[0])
+    block_size = settings['processing']['block_size']
+
+    with rasterio.open(path) as src:
+        kwargs = src.meta.copy()
+        kwargs.update(
+            driver='GTiff',
+            tiled=True,
+            blockxsize=block_size,
+            blockysize=block_size,
+            compress='deflate')
+
+        # write to a temporary file then rename it, so that the processing
+        # never reads a partially written file
+        fd, tmp = tempfile.mkstemp(suffix='.tif',
+                                   dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            with rasterio.open(tmp, 'w', **kwargs) as dst:
+                # one row of tiles at a time, stripped sources are read
+                # sequentially
+                height, width = src.shape
+                for row in range(0, height, block_size):
+                    window = ((row, min(row + block_size, height)),
+                              (0, width))
+                    for band in range(1, src.count + 1):
+                        dst.write(src.read(band, window=window), band,
+                                  window=window)
+                factors = overview_factors(src.shape, block_size)
+                if factors:
+                    dst.build_overviews(factors, Resampling.nearest)
+                    dst.update_tags(ns='rio_overview', resampling='nearest')
+            os.rename(tmp, prepared_path)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    return prepared_path
+
+
+def overview_factors(shape, block_size):
+    '''Return the decimation factors of the overviews of a raster of the
+    given shape: powers of 2, until an overview fits in a block.'''
+    factors = []
+    factor = 2
+    while max(shape) // factor >= block_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
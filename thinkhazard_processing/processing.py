@@ -1,35 +1,62 @@
 # -*- coding: utf-8 -*-
 
+import os
+import hashlib
 import transaction
+import array
 import datetime
-import numpy
+import traceback
+import multiprocessing
 import rasterio
-import pyproj
-from rasterio import features
-from shapely.ops import (
-    transform,
-    cascaded_union
-)
-from shapely.geometry import Polygon
-from functools import partial
-from geoalchemy2.shape import to_shape
-from sqlalchemy import func
-
-from thinkhazard_common.models import (
-    DBSession,
-    AdministrativeDivision,
-    AdminLevelType,
-    HazardLevel,
-    HazardType,
-    HazardCategory,
-    hazardcategory_administrativedivision_table,
+from itertools import izip
+from cStringIO import StringIO
+from sqlalchemy import (
+    and_,
+    engine_from_config,
+    exists,
+    select,
     )
+from zope.sqlalchemy import mark_changed
+
+from thinkhazard_common.models import DBSession
 from .models import (
     HazardSet,
-    Layer,
+    HazardSetProgress,
     Output,
+    OutputChange,
+    OutputStaging,
+    catalogue,
     )
 from . import settings
+from .cache import mask_cache
+from .metrics import metrics
+from .index import (
+    division_index,
+    query_geometries,
+    )
+from .levels import (
+    level_thresholds,
+    open_hazardlevels,
+    signature,
+    )
+from .readers import (
+    memory_reader,
+    memory_readers,
+    )
+from .zonal import (
+    ZonalDivisions,
+    evaluate_readers,
+    open_layers,
+    readers_polygon,
+    select_engine,
+    )
+
+
+# to be increased when the results of the processing change
+VERSION = 2
+
+# size of the chunks of the layer files read to hash them, in bytes
+HASH_CHUNK_SIZE = 1024 * 1024
 
 
 class ProcessException(Exception):
@@ -37,7 +64,11 @@ class ProcessException(Exception):
         self.message = message
 
 
-def process(hazardset_id=None, force=False):
+def process(hazardset_id=None, force=False, jobs=1, really_force=False):
+    '''Process the complete hazardsets not processed yet, or all of them
+    if `force` is True. Those whose inputs did not change since they were
+    processed are skipped anyway, unless `really_force` is True.'''
+    force = force or really_force
     hazardsets = DBSession.query(HazardSet)
     hazardsets = hazardsets.filter(HazardSet.complete.is_(True))
     if hazardset_id is not None:
@@ -47,228 +78,201 @@ def process(hazardset_id=None, force=False):
     if hazardsets.count() == 0:
         print 'No hazardsets to process'
         return
-    for hazardset in hazardsets:
-        process_hazardset(hazardset, force=force)
-
-
-def upscale_hazardcategories(target_adminlevel_mnemonic):
-    # identify the admin divisions matching the given level:
-    admindivs = DBSession.query(AdministrativeDivision)\
-        .join(AdminLevelType) \
-        .filter(AdminLevelType.mnemonic == target_adminlevel_mnemonic)
-    hazardtypes = DBSession.query(HazardType)
-    # for each of these admin divisions and hazard types,
-    # identify the highest HazardCategory among their children:
-    for admindiv in admindivs:
-        # identify max(level) for each hazardtype across children
-        for hazardtype in hazardtypes:
-            hazardcategory = DBSession.query(HazardCategory) \
-                .join((AdministrativeDivision, HazardCategory.administrativedivisions)) \
-                .join(HazardType) \
-                .join(HazardLevel) \
-                .filter(HazardType.id == hazardtype.id) \
-                .filter(AdministrativeDivision.parent == admindiv) \
-                .order_by(HazardLevel.order.asc()).first()
-            if hazardcategory:
-                # find the highest hazardlevel for all children admindivs
-                print '[upscaling] admindiv {} inherits hazardlevel {} for {}'\
-                    .format(admindiv.code, hazardcategory.hazardlevel_id,
-                            hazardcategory.hazardtype.mnemonic)
-                admindiv.hazardcategories.append(hazardcategory)
-                DBSession.add(admindiv)
-
-
-def process_outputs():
-    print "Decision Tree running..."
-    # first of all, remove all records
-    # in the datamart table linking admin divs with hazard categories:
-    hazardcategory_administrativedivision_table.delete()
-    # identify the admin level for which we run the decision tree:
-    # (REG)ion aka admin level 2
-    dt_level = DBSession.query(AdminLevelType)\
-        .filter(AdminLevelType.mnemonic == u'REG').one()
-    # then, identify the unique (admindiv, hazardtype) tuples
-    # contained in the Output table:
-    admindiv_hazardtype_tuples = (
-        DBSession.query(AdministrativeDivision, HazardType).distinct()
-        .join(Output)
-        .join(HazardSet)
-        .join(HazardType)
-        # the following should not be necessary in production
-        # because only the lowest admin levels should be inserted
-        # in the Output table:
-        .filter(AdministrativeDivision.leveltype_id == dt_level.id)
-        # not necessary, but practical for debugging:
-        .order_by(AdministrativeDivision.code)
-    )
-    # for each tuple, identify the most relevant HazardSet
-    # in the light of the criteria that we all agreed on (cf Decision Tree):
-    for (admindiv, hazardtype) in admindiv_hazardtype_tuples:
-        (hazardset, output) = DBSession.query(HazardSet, Output) \
-            .join(Output) \
-            .filter(Output.admin_id == admindiv.id) \
-            .filter(HazardSet.hazardtype_id == hazardtype.id) \
-            .order_by(HazardSet.calculation_method_quality.desc(),
-                      HazardSet.scientific_quality.desc(),
-                      HazardSet.local.desc(),
-                      HazardSet.data_lastupdated_date.desc()).first()
-        print "[decision tree] admindiv {} gets hazardlevel {} from {} for {}"\
-            .format(admindiv.code, output.hazardlevel_id, hazardset.id,
-                    hazardtype.mnemonic)
-        # find the relevant HazardCategory for the current hazardtype
-        # and the hazardset's hazardlevel
-        hazardcategory = DBSession.query(HazardCategory) \
-            .filter(HazardCategory.hazardtype_id == hazardtype.id) \
-            .filter(HazardCategory.hazardlevel_id == output.hazardlevel_id) \
-            .one()
-        # append new hazardcategory to current admin div:
-        admindiv.hazardcategories.append(hazardcategory)
-        DBSession.add(admindiv)
-
-    # UpScaling level2 (REG)ion -> level1 (PRO)vince
-    upscale_hazardcategories(u'PRO')
-    # UpScaling level1 (PRO)vince -> level0 (COU)ntry
-    upscale_hazardcategories(u'COU')
-
-    transaction.commit()
-
-
-def process_hazardset(hazardset, force=False):
+    catalogue.load([hazardset.id for hazardset in hazardsets])
+    # built once for all the hazardsets, and inherited by the workers
+    metrics.reset(u'division_index')
+    division_index.load()
+    metrics.write()
+    try:
+        if jobs > 1:
+            if hazardsets.count() == 1:
+                # share the divisions of the hazardset between the workers
+                process_hazardset(hazardsets.one(), force=force, jobs=jobs,
+                                  really_force=really_force)
+            else:
+                process_parallel([hazardset.id for hazardset in hazardsets],
+                                 force=force, jobs=jobs,
+                                 really_force=really_force)
+            return
+        for hazardset in hazardsets:
+            process_hazardset(hazardset, force=force,
+                              really_force=really_force)
+    finally:
+        catalogue.invalidate()
+        division_index.invalidate()
+
+
+def process_parallel(hazardset_ids, force=False, jobs=2,
+                     really_force=False):
+    '''Process the given hazardsets in a pool of `jobs` worker processes.
+
+    Each worker opens its own database connection. A failing hazardset
+    is reported and does not abort the processing of the other ones.
+    Returns the list of the identifiers of the failed hazardsets.'''
+    # release the connections of the parent process before forking,
+    # they must not be shared with the workers
+    transaction.abort()
+    engine = DBSession.bind
+    DBSession.remove()
+    if engine is not None:
+        engine.dispose()
+
+    failed = []
+    pool = multiprocessing.Pool(jobs, _init_worker)
+    try:
+        results = pool.imap_unordered(
+            _process_hazardset_job,
+            [(hazardset_id, force, really_force)
+             for hazardset_id in hazardset_ids])
+        for hazardset_id, error in results:
+            if error is None:
+                print '[jobs] hazardset {} processed'.format(hazardset_id)
+            else:
+                print '[jobs] hazardset {} failed:\n{}'.format(
+                    hazardset_id, error)
+                failed.append(hazardset_id)
+    finally:
+        pool.close()
+        pool.join()
+
+    print '[jobs] {} hazardsets processed, {} failed'.format(
+        len(hazardset_ids) - len(failed), len(failed))
+    for hazardset_id in failed:
+        print '[jobs]   failed: {}'.format(hazardset_id)
+    return failed
+
+
+def _init_worker():
+    # each worker process has its own engine and session.
+    # the session inherited from the parent process is dropped
+    # without being closed, its connection still belongs to the parent
+    DBSession.registry.clear()
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+
+
+def _process_hazardset_job(args):
+    hazardset_id, force, really_force = args
+    try:
+        hazardset = DBSession.query(HazardSet).get(hazardset_id)
+        if hazardset is None:
+            raise ProcessException('HazardSet {} does not exist.'
+                                   .format(hazardset_id))
+        process_hazardset(hazardset, force=force, really_force=really_force)
+    except Exception:
+        transaction.abort()
+        # tracebacks are not picklable, send back the formatted one
+        return (hazardset_id, traceback.format_exc())
+    return (hazardset_id, None)
+
+
+def process_hazardset(hazardset, force=False, jobs=1, really_force=False):
     print hazardset.id
     chrono = datetime.datetime.now()
+    metrics.reset(hazardset.id)
     last_percent = 0
 
-    level_VLO = HazardLevel.get(u'VLO')
-
     if hazardset is None:
         raise ProcessException('HazardSet {} does not exist.'
                                .format(hazardset.id))
 
-    if hazardset.processed:
-        if force:
-            hazardset.processed = False
-        else:
-            raise ProcessException('HazardSet {} has already been processed.'
-                                   .format(hazardset.id))
-
-    # clean previous outputs
-    DBSession.query(Output) \
-        .filter(Output.hazardset_id == hazardset.id) \
-        .delete()
-    DBSession.flush()
+    if hazardset.processed and not (force or really_force):
+        raise ProcessException('HazardSet {} has already been processed.'
+                               .format(hazardset.id))
 
     hazardtype = hazardset.hazardtype
     hazardtype_settings = settings['hazard_types'][hazardtype.mnemonic]
     thresholds = hazardtype_settings['thresholds']
 
-    project = partial(
-        pyproj.transform,
-        pyproj.Proj(init='epsg:3857'),
-        pyproj.Proj(init='epsg:4326'))
+    layers = hazardset_layers(hazardset)
+    with metrics.stage('fingerprint'):
+        inputs_fingerprint = fingerprint(layers, thresholds)
+    if hazardset.processed:
+        if not really_force and inputs_fingerprint is not None and \
+                hazardset.fingerprint == inputs_fingerprint:
+            print '  inputs unchanged since the last processing, skipping'
+            return
+        hazardset.processed = False
 
-    layers = {}
-    for level in (u'HIG', u'MED', u'LOW'):
-        hazardlevel = HazardLevel.get(level)
-        layer = DBSession.query(Layer) \
-            .filter(Layer.hazardset_id == hazardset.id) \
-            .filter(Layer.hazardlevel_id == hazardlevel.id) \
-            .one()
-        layers[level] = layer
+    hazardlevels = {}
+    for level in (u'VLO', u'LOW', u'MED', u'HIG'):
+        hazardlevels[level] = catalogue.hazardlevel(level)
 
-    with rasterio.drivers():
-        with rasterio.open(layers['HIG'].path()) as src_hig, \
-                rasterio.open(layers['MED'].path()) as src_med, \
-                rasterio.open(layers['LOW'].path()) as src_low:
-            readers = {}
-            readers['HIG'] = src_hig
-            readers['MED'] = src_med
-            readers['LOW'] = src_low
-
-            polygon_hig = polygonFromBounds(src_hig.bounds)
-            polygon_med = polygonFromBounds(src_med.bounds)
-            polygon_low = polygonFromBounds(src_low.bounds)
-            polygon = cascaded_union((
-                polygon_hig,
-                polygon_med,
-                polygon_low))
-
-            adminlevel_REG = AdminLevelType.get(u'REG')
-
-            admindivs = DBSession.query(AdministrativeDivision) \
-                .filter(AdministrativeDivision.leveltype_id == adminlevel_REG.id) \
-
-            if hazardset.local:
-                admindivs = admindivs \
-                    .filter(
-                        func.ST_Transform(AdministrativeDivision.geom, 4326)
-                        .intersects(
-                            func.ST_GeomFromText(polygon.wkt, 4326))) \
-                    .filter(func.ST_Intersects(
-                        func.ST_Transform(AdministrativeDivision.geom, 4326),
-                        func.ST_GeomFromText(polygon.wkt, 4326)))
-
-            current = 0
-            outputs = 0
-            total = admindivs.count()
-            for admindiv in admindivs:
-                # print ' ', admindiv.id, admindiv.code, admindiv.name
+    cache = mask_cache()
 
+    with rasterio.drivers():
+        with open_readers(layers) as readers, \
+                open_hazardlevels(hazardset, layers, thresholds) as levels:
+            polygon = readers_polygon(readers)
+
+            engine = select_engine(settings['processing']['engine'],
+                                   readers, hazardset.local)
+            print '  using {} engine{}'.format(
+                engine, ' with {} jobs'.format(jobs) if jobs > 1 else '')
+            # small rasters are read in memory once, only those which
+            # are read by the engines
+            if levels is not None:
+                print '  using hazard levels raster'
+                levels = memory_reader(levels, 'hazard levels raster')
+            else:
+                readers = memory_readers(readers)
+
+            admin_ids, inside = division_index.candidates(polygon)
+            total = len(admin_ids)
+
+            # resume the processing from the last checkpoint, if any,
+            # staged with the same inputs and version of the processing
+            progress, done = resume_hazardset(
+                hazardset, total,
+                '{}-{}-{}'.format(VERSION, signature(layers, thresholds),
+                                  division_index.signature))
+            if len(done) > 0:
+                print '  resuming after {} divisions'.format(len(done))
+                admin_ids = [admin_id for admin_id in admin_ids
+                             if admin_id not in done]
+            checkpoint_size = settings['processing']['checkpoint_size']
+
+            per_level = level_thresholds(layers, thresholds)
+            if len(admin_ids) == 0:
+                results = []
+            elif engine == 'zonal':
+                # the results are yielded band after band of the grid and
+                # checkpointed meanwhile, the geometries are all loaded
+                # first as their stream would not survive the commits
+                admindivs = list(query_geometries(admin_ids))
+                if jobs > 1:
+                    results = zonal_admindivs_parallel(hazardset, admindivs,
+                                                       readers, jobs, cache)
+                else:
+                    results = evaluate_readers(admindivs, readers, per_level,
+                                               engine, cache=cache,
+                                               levels=levels)
+            elif jobs > 1:
+                results = process_admindivs_parallel(hazardset, admin_ids,
+                                                     inside, jobs)
+            else:
+                # the geometries are loaded by chunks, as their stream
+                # would not survive the commits of the checkpoints
+                results = (
+                    result
+                    for i in range(0, len(admin_ids), checkpoint_size)
+                    for result in evaluate_readers(
+                        list(query_geometries(
+                            admin_ids[i:i + checkpoint_size])),
+                        readers, per_level, engine, polygon, cache, inside,
+                        levels))
+
+            current = len(done)
+            outputs = OutputBuffer()
+            for admin_id, level, coverage_ratio in results:
                 current += 1
-                if admindiv.geom is None:
-                    print '   ', ('{}-{} has null geometry'
-                                  .format(admindiv.code, admindiv.name))
-                    continue
-
-                reprojected = transform(
-                    project,
-                    to_shape(admindiv.geom))
-
-                output = Output()
-                output.hazardset = hazardset
-                output.administrativedivision = admindiv
-                output.hazardlevel = None
-
-                # TODO: calculate coverage ratio
-                output.coverage_ratio = 100
-
-                for level in (u'HIG', u'MED', u'LOW'):
-                    layer = layers[level]
-                    src = readers[level]
-
-                    if not reprojected.intersects(polygon):
-                        continue
-
-                    window = src.window(*reprojected.bounds)
-                    data = src.read(1, window=window, masked=True)
-                    if data.shape[0] * data.shape[1] == 0:
-                        continue
-
-                    threshold = thresholds[layer.hazardunit]
-                    positive_data = (data > threshold).astype(rasterio.uint8)
-
-                    division = features.rasterize(
-                        ((g, 1) for g in [reprojected]),
-                        out_shape=data.shape,
-                        transform=src.window_transform(window),
-                        all_touched=True)
-
-                    masked = numpy.ma.masked_array(positive_data,
-                                                   mask=~division.astype(bool))
-
-                    if str(numpy.max(masked)) == str(numpy.ma.masked):
-                        break
-                    else:
-                        if output.hazardlevel is None:
-                            output.hazardlevel = level_VLO
-
-                    if numpy.max(masked) > 0:
-                        output.hazardlevel = layer.hazardlevel
-                        break
-
-                if output.hazardlevel is not None:
-                    # print '    hazardlevel :', output.hazardlevel.mnemonic
-                    DBSession.add(output)
-                    outputs += 1
+
+                outputs.append(
+                    admin_id,
+                    hazardlevels[level].id if level is not None else None,
+                    coverage_ratio)
+                if len(outputs) >= checkpoint_size:
+                    checkpoint(hazardset.id, outputs, progress, current)
 
                 percent = int(100.0 * current / total)
                 if percent % 10 == 0 and percent != last_percent:
@@ -276,19 +280,341 @@ def process_hazardset(hazardset, force=False):
                     last_percent = percent
                     pass
 
-    hazardset.processed = True
+            checkpoint(hazardset.id, outputs, progress, current)
 
-    DBSession.flush()
-    transaction.commit()
+    # replace previous outputs
+    with metrics.stage('write'):
+        count = publish_outputs(hazardset.id)
 
-    print ('Successfully processed {} divisions, {} outputs generated in {}'
-           .format(total, outputs, datetime.datetime.now() - chrono))
+        hazardset.processed = True
+        hazardset.fingerprint = inputs_fingerprint
 
+        DBSession.flush()
+        transaction.commit()
 
-def polygonFromBounds(bounds):
-    return Polygon([
-        (bounds[0], bounds[1]),
-        (bounds[0], bounds[3]),
-        (bounds[2], bounds[3]),
-        (bounds[2], bounds[1]),
-        (bounds[0], bounds[1])])
+    print ('Successfully processed {} divisions, {} outputs generated in {}'
+           .format(total, count, datetime.datetime.now() - chrono))
+    metrics.write(engine=engine, divisions=total, outputs=count,
+                  resumed=len(done), jobs=jobs)
+
+
+def fingerprint(layers, thresholds):
+    '''Return the fingerprint of the inputs of the processing of a
+    hazardset: the size, modification time and hash of its layer files,
+    their thresholds, the version of the processing and the signature of
+    the division geometries. Returns None if a layer file is missing, then
+    the inputs are considered as changed.'''
+    parts = [VERSION, division_index.signature]
+    for level in (u'HIG', u'MED', u'LOW'):
+        path = layers[level].processing_path()
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        parts.append((level, stat.st_size, stat.st_mtime, file_hash(path),
+                      thresholds[layers[level].hazardunit]))
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def file_hash(path):
+    '''Return the SHA-1 of the content of the file, read by chunks.'''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), ''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def resume_hazardset(hazardset, total, signature):
+    '''Return the progress record of the hazardset and the set of the ids
+    of the divisions already processed. Results staged with other inputs,
+    as told by their `signature`, are discarded.'''
+    progress = DBSession.query(HazardSetProgress).get(hazardset.id)
+    if progress is not None and progress.signature != signature:
+        print '  inputs changed since the last checkpoint, starting over'
+        DBSession.delete(progress)
+        progress = None
+    if progress is None:
+        DBSession.query(OutputStaging) \
+            .filter(OutputStaging.hazardset_id == hazardset.id) \
+            .delete()
+        progress = HazardSetProgress()
+        progress.hazardset_id = hazardset.id
+        progress.signature = signature
+        progress.processed = 0
+        DBSession.add(progress)
+    progress.total = total
+
+    done = set(row[0] for row in DBSession.query(OutputStaging.admin_id)
+               .filter(OutputStaging.hazardset_id == hazardset.id))
+    DBSession.flush()
+    transaction.commit()
+    return progress, done
+
+
+def checkpoint(hazardset_id, outputs, progress, processed):
+    '''Stage the buffered results, update the progress record and commit,
+    so that an interrupted processing resumes from here.'''
+    with metrics.stage('write'):
+        outputs.stage(hazardset_id)
+        progress.processed = processed
+        progress.updated = datetime.datetime.now()
+        DBSession.flush()
+        transaction.commit()
+
+
+class OutputBuffer(object):
+    '''Compact buffer of the results of a hazardset, which are staged in
+    bulk instead of going through the session one ORM object at a time.'''
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return len(self.admin_ids)
+
+    def clear(self):
+        self.admin_ids = array.array('l')
+        # 0 stands for divisions which are not covered by the hazardset
+        self.hazardlevel_ids = array.array('l')
+        self.coverage_ratios = array.array('B')
+
+    def append(self, admin_id, hazardlevel_id, coverage_ratio):
+        self.admin_ids.append(admin_id)
+        self.hazardlevel_ids.append(hazardlevel_id or 0)
+        self.coverage_ratios.append(coverage_ratio or 0)
+
+    def stage(self, hazardset_id):
+        '''Move the buffered results to the staging table, within the current
+        transaction, using COPY FROM.'''
+        DBSession.flush()
+        data = StringIO()
+        hazardset_id = hazardset_id.encode('utf-8')
+        for admin_id, hazardlevel_id, coverage_ratio in izip(
+                self.admin_ids, self.hazardlevel_ids, self.coverage_ratios):
+            if hazardlevel_id == 0:
+                data.write('{}\t{}\t\\N\t\\N\n'.format(hazardset_id,
+                                                       admin_id))
+            else:
+                data.write('{}\t{}\t{}\t{}\n'.format(
+                    hazardset_id, admin_id, hazardlevel_id, coverage_ratio))
+        data.seek(0)
+
+        cursor = DBSession.connection().connection.cursor()
+        cursor.copy_expert(
+            'COPY processing.output_staging '
+            '(hazardset_id, admin_id, hazardlevel_id, coverage_ratio) '
+            'FROM STDIN', data)
+        mark_changed(DBSession())
+        self.clear()
+
+
+def publish_outputs(hazardset_id):
+    '''Replace the outputs of the hazardset by its staged results, within
+    the current transaction, so that readers never see a partial set of
+    outputs. Return the number of outputs.'''
+    DBSession.flush()
+    record_output_changes(hazardset_id)
+    DBSession.execute(Output.__table__.delete()
+                      .where(Output.hazardset_id == hazardset_id))
+
+    staging = OutputStaging.__table__
+    count = DBSession.execute(Output.__table__.insert().from_select(
+        ['hazardset_id', 'admin_id', 'hazardlevel_id', 'coverage_ratio'],
+        select([staging.c.hazardset_id,
+                staging.c.admin_id,
+                staging.c.hazardlevel_id,
+                staging.c.coverage_ratio])
+        .where(staging.c.hazardset_id == hazardset_id)
+        .where(staging.c.hazardlevel_id.isnot(None)))).rowcount
+    record_output_changes(hazardset_id)
+
+    DBSession.execute(staging.delete()
+                      .where(staging.c.hazardset_id == hazardset_id))
+    DBSession.execute(HazardSetProgress.__table__.delete()
+                      .where(HazardSetProgress.hazardset_id == hazardset_id))
+    mark_changed(DBSession())
+    return count
+
+
+def record_output_changes(hazardset_id):
+    '''Record the admin divisions having an output from the hazardset
+    as changed for the next incremental run of the decision tree.'''
+    DBSession.execute(OutputChange.__table__.insert().from_select(
+        ['hazardset_id', 'admin_id'],
+        select([Output.hazardset_id, Output.admin_id])
+        .where(Output.hazardset_id == hazardset_id)
+        .where(~exists().where(and_(
+            OutputChange.hazardset_id == Output.hazardset_id,
+            OutputChange.admin_id == Output.admin_id)))))
+
+
+def hazardset_layers(hazardset):
+    layers = {}
+    for level in (u'HIG', u'MED', u'LOW'):
+        layer = hazardset.layerByLevel(level)
+        if layer is None:
+            raise ProcessException('HazardSet {} has no {} layer.'
+                                   .format(hazardset.id, level))
+        layers[level] = layer
+    return layers
+
+
+def open_readers(layers):
+    return open_layers(dict((level, layers[level].processing_path())
+                            for level in (u'HIG', u'MED', u'LOW')))
+
+
+def process_admindivs_parallel(hazardset, admin_ids, inside, jobs):
+    '''Share the given administrative divisions of a hazardset between
+    `jobs` worker processes, by chunks of contiguous ids. Yield the
+    (admin id, hazard level mnemonic, coverage ratio) tuples as the chunks
+    complete. See zonal.process_admindivs for `inside`.'''
+    # a few chunks per worker so that the load is balanced
+    count = jobs * 4
+    size = max(1, (len(admin_ids) + count - 1) // count)
+    chunks = []
+    for i in range(0, len(admin_ids), size):
+        chunk = admin_ids[i:i + size]
+        chunks.append((chunk, [admin_id for admin_id in chunk
+                               if admin_id in inside]))
+
+    # the workers must not share the idle connections of the parent
+    engine = DBSession.bind
+    if engine is not None:
+        engine.dispose()
+
+    pool = multiprocessing.Pool(jobs, _init_chunk_worker, (hazardset.id,))
+    try:
+        for results, state in pool.imap_unordered(_process_chunk_job,
+                                                  chunks):
+            # the timings of the workers are gathered in the parent
+            metrics.merge(state)
+            for result in results:
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def zonal_admindivs_parallel(hazardset, admindivs, readers, jobs,
+                             cache=None):
+    '''Share the bands of windows streamed by the zonal engine over the grid
+    of a hazardset between `jobs` worker processes, see
+    zonal.ZonalDivisions. Yield the (admin id, hazard level mnemonic,
+    coverage ratio) tuples of the given (admin id, geometry) tuples as the
+    divisions complete.'''
+    divisions = ZonalDivisions(admindivs, readers, cache, jobs)
+    bands = divisions.bands()
+    # divisions out of the grid
+    for result in divisions.finished(0):
+        yield result
+
+    # inherited by the workers, see _reduce_band_job
+    _chunk_worker['divisions'] = divisions
+    _chunk_worker['bands'] = bands
+
+    # the workers must not share the idle connections of the parent
+    engine = DBSession.bind
+    if engine is not None:
+        engine.dispose()
+
+    pool = multiprocessing.Pool(jobs, _init_chunk_worker, (hazardset.id,))
+    try:
+        # the bands are merged in order, from top to bottom,
+        # so that the divisions complete as soon as possible
+        for band, (partial, state) in izip(
+                bands, pool.imap(_reduce_band_job, range(len(bands)))):
+            metrics.merge(state)
+            divisions.merge(partial)
+            for result in divisions.finished(band[0][0][1]):
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+        del _chunk_worker['divisions']
+        del _chunk_worker['bands']
+
+
+# state of a chunk worker process, see _init_chunk_worker
+_chunk_worker = {}
+
+
+def _init_chunk_worker(hazardset_id):
+    # an error raised by an initializer makes the pool start the worker
+    # again and again, it is raised by the jobs instead, see chunk_worker
+    try:
+        _setup_chunk_worker(hazardset_id)
+    except Exception:
+        _chunk_worker['error'] = traceback.format_exc()
+
+
+def _setup_chunk_worker(hazardset_id):
+    # each worker has its own session and holds its own open readers
+    # for the whole life of the pool
+    _init_worker()
+    hazardset = DBSession.query(HazardSet).get(hazardset_id)
+    hazardtype_settings = settings['hazard_types'][
+        hazardset.hazardtype.mnemonic]
+    layers = hazardset_layers(hazardset)
+
+    drivers = rasterio.drivers()
+    drivers.__enter__()
+    readers = {}
+    for level in (u'HIG', u'MED', u'LOW'):
+        readers[level] = rasterio.open(layers[level].processing_path())
+    polygon = readers_polygon(readers)
+    thresholds = hazardtype_settings['thresholds']
+    hazardlevels = open_hazardlevels(hazardset, layers, thresholds)
+    levels = hazardlevels.__enter__()
+    if levels is not None:
+        levels = memory_reader(levels, 'hazard levels raster')
+    else:
+        readers = memory_readers(readers)
+
+    _chunk_worker.update({
+        'cache': mask_cache(),
+        'drivers': drivers,
+        'hazardset': hazardset,
+        'readers': readers,
+        'thresholds': level_thresholds(layers, thresholds),
+        'polygon': polygon,
+        'hazardlevels': hazardlevels,
+        'levels': levels,
+        })
+
+
+def chunk_worker():
+    '''Return the state of the chunk worker process, or raise the error of
+    its setup so that it reaches the parent process.'''
+    if 'error' in _chunk_worker:
+        raise ProcessException('Worker setup failed:\n{}'
+                               .format(_chunk_worker['error']))
+    return _chunk_worker
+
+
+def _process_chunk_job(chunk):
+    admin_ids, inside = chunk
+    worker = chunk_worker()
+    metrics.reset(worker['hazardset'].id)
+    results = list(evaluate_readers(
+        query_geometries(admin_ids),
+        worker['readers'],
+        worker['thresholds'],
+        'window',
+        worker['polygon'],
+        worker['cache'],
+        set(inside),
+        worker['levels']))
+    return results, metrics.state()
+
+
+def _reduce_band_job(index):
+    worker = chunk_worker()
+    metrics.reset(worker['hazardset'].id)
+    partial = worker['divisions'].reduce(
+        worker['readers'],
+        worker['thresholds'],
+        worker['bands'][index],
+        worker['cache'],
+        worker['levels'])
+    return partial, metrics.state()
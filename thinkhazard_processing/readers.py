@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import numpy
+
+from . import settings
+
+
+class ArrayReader(object):
+    '''Stand-in for the rasterio reader of a small raster, whose first band
+    is read in memory once. Windows are then read as read-only views of the
+    array, without copy nor GDAL call.'''
+
+    def __init__(self, src):
+        self.src = src
+        self.shape = src.shape
+        self.transform = src.transform
+        self.bounds = src.bounds
+        self.block_shapes = src.block_shapes
+        self.dtypes = src.dtypes
+
+        band = src.read(1, masked=True)
+        self.data = numpy.ma.getdata(band)
+        self.mask = numpy.ma.getmaskarray(band)
+        self.data.flags.writeable = False
+        self.mask.flags.writeable = False
+
+    def window(self, left, bottom, right, top):
+        return self.src.window(left, bottom, right, top)
+
+    def window_transform(self, window):
+        return self.src.window_transform(window)
+
+    def read(self, band, window=None, masked=False):
+        if band != 1:
+            raise ValueError('only the first band is read in memory')
+        if window is None:
+            rows = cols = slice(None)
+        else:
+            (row_start, row_stop), (col_start, col_stop) = window
+            rows = slice(max(row_start, 0), max(row_stop, 0))
+            cols = slice(max(col_start, 0), max(col_stop, 0))
+        if masked:
+            return numpy.ma.masked_array(self.data[rows, cols],
+                                         mask=self.mask[rows, cols])
+        return self.data[rows, cols]
+
+
+def memory_reader(src, name):
+    '''Return an ArrayReader for the raster if its first band and its mask
+    fit in the processing.in_memory_size setting (in MB), the rasterio
+    reader itself otherwise. The chosen mode is logged.'''
+    height, width = src.shape
+    size = height * width * (numpy.dtype(src.dtypes[0]).itemsize + 1)
+    if size <= settings['processing']['in_memory_size'] * 1024 * 1024:
+        print '  reading {} in memory'.format(name)
+        return ArrayReader(src)
+    print '  reading {} with GDAL'.format(name)
+    return src
+
+
+def memory_readers(readers):
+    '''Apply memory_reader to the readers of the three layers.'''
+    return dict((level, memory_reader(readers[level],
+                                      '{} layer'.format(level)))
+                for level in (u'HIG', u'MED', u'LOW'))
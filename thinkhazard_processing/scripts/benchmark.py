@@ -0,0 +1,79 @@
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import rasterio
+from sqlalchemy import engine_from_config
+from thinkhazard_common.models import DBSession
+from .. import settings
+from ..benchmark import benchmark
+from ..metrics import profile
+from .initializedb import initdb_processing
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the processing and the decision tree on '
+                    'synthetic data')
+    parser.add_argument(
+        '--url', dest='url', action='store', required=True,
+        help='The URL of a throwaway database, whose tables are dropped')
+    parser.add_argument(
+        '--resolutions', dest='resolutions', action='store',
+        default='0.5,0.1',
+        help='The comma separated resolutions of the synthetic layers, '
+             'in degrees')
+    parser.add_argument(
+        '--engines', dest='engines', action='store', default='zonal,window',
+        help='The comma separated processing engines to benchmark')
+    parser.add_argument(
+        '--countries', dest='countries', action='store', type=int,
+        default=10,
+        help='The number of synthetic countries')
+    parser.add_argument(
+        '--split', dest='split', action='store', type=int, default=4,
+        help='The number of subdivisions of each division along each axis')
+    parser.add_argument(
+        '--vertices', dest='vertices', action='store', type=int, default=50,
+        help='The number of vertices per edge of the divisions')
+    parser.add_argument(
+        '--hazardlevels', dest='hazardlevels',
+        action='store_const', const=True, default=False,
+        help='Process from the hazard levels rasters')
+    parser.add_argument(
+        '--jobs', dest='jobs', action='store', type=int, default=1,
+        help='The number of worker processes')
+    parser.add_argument(
+        '--output', dest='output', action='store', default='benchmark.json',
+        help='The JSON file the results are written to')
+    parser.add_argument(
+        '--profile', dest='profile', action='store', metavar='FILE',
+        help='Dump the cProfile statistics of the run to FILE')
+    args = parser.parse_args(argv[1:])
+
+    # the workers of the --jobs option connect with the settings too
+    settings['sqlalchemy.url'] = args.url
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    initdb_processing(engine, True)
+    DBSession.configure(bind=engine)
+
+    data_path = tempfile.mkdtemp(prefix='thinkhazard_benchmark_')
+    settings['data_path'] = data_path
+    settings['processing']['metrics_file'] = 'metrics.jsonl'
+    try:
+        with rasterio.drivers(), profile(args.profile):
+            results = benchmark(
+                [float(value) for value in args.resolutions.split(',')],
+                args.engines.split(','),
+                args.countries,
+                args.split,
+                args.vertices,
+                hazardlevels=args.hazardlevels,
+                jobs=args.jobs)
+    finally:
+        shutil.rmtree(data_path)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print 'Results written to {}'.format(args.output)
@@ -1,15 +1,36 @@
 # coding: utf-8
 
 import sys
+import argparse
 from sqlalchemy import engine_from_config
 from thinkhazard_common.models import DBSession
 from .. import settings
-from ..processing import (
-    process_outputs,
-    )
+from ..metrics import profile
+from ..decision_tree import process_outputs
 
 
 def main(argv=sys.argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--summary', dest='summary',
+        action='store_const', const=True, default=False,
+        help='Print the number of admin divisions per hazard level')
+    parser.add_argument(
+        '--incremental', dest='incremental',
+        action='store_const', const=True, default=False,
+        help='Only update the admin divisions whose outputs changed '
+             'since the last run')
+    parser.add_argument(
+        '--min-coverage', dest='min_coverage', type=int, default=0,
+        help='Ignore the outputs covering less than this percentage '
+             'of their admin division')
+    parser.add_argument(
+        '--profile', dest='profile', action='store', metavar='FILE',
+        help='Dump the cProfile statistics of the run to FILE')
+    args = parser.parse_args(argv[1:])
+
     engine = engine_from_config(settings, 'sqlalchemy.')
     DBSession.configure(bind=engine)
-    process_outputs()
+    with profile(args.profile):
+        process_outputs(summary=args.summary, incremental=args.incremental,
+                        min_coverage=args.min_coverage)
@@ -0,0 +1,31 @@
+import sys
+import argparse
+from sqlalchemy import engine_from_config
+from thinkhazard_common.models import DBSession
+from .. import settings
+from ..download import download
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--hazardset_id',  dest='hazardset_id', action='store',
+        help='The hazard set identifier')
+    parser.add_argument(
+        '--force', dest='force',
+        action='store_const', const=True, default=False,
+        help='Force download even if layers have already been downloaded')
+    parser.add_argument(
+        '--jobs', dest='jobs', action='store', type=int,
+        help='The number of layers to download concurrently')
+    args = parser.parse_args(argv[1:])
+
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+
+    failed = download(
+        hazardset_id=args.hazardset_id,
+        force=args.force,
+        jobs=args.jobs)
+    if failed:
+        sys.exit(1)
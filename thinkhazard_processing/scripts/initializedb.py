@@ -1,5 +1,8 @@
 import sys
-from sqlalchemy import engine_from_config
+from sqlalchemy import (
+    engine_from_config,
+    text,
+    )
 
 from thinkhazard_common.scripts.initializedb import (
     initdb,
@@ -10,10 +13,37 @@ from ..models import Base  # NOQA
 from .. import settings
 
 
+# columns added to the tables of the processing schema since they were
+# first released, as (table, column, type) tuples, see upgrade_processing
+UPGRADE_COLUMNS = [
+    ('hazardset', 'fingerprint', 'varchar'),
+    ('layer', 'prepared_path', 'varchar'),
+    ]
+
+
 def initdb_processing(engine, drop_all=False):
     if not schema_exists(engine, 'processing'):
         engine.execute("CREATE SCHEMA processing;")
     initdb(engine, drop_all=drop_all)
+    upgrade_processing(engine)
+
+
+def upgrade_processing(engine):
+    '''Add the missing columns of UPGRADE_COLUMNS to the existing tables,
+    which create_all does not alter. The harvested data are kept, and
+    running it again does nothing.'''
+    for table, column, type_ in UPGRADE_COLUMNS:
+        if not column_exists(engine, 'processing', table, column):
+            engine.execute('ALTER TABLE processing.{} ADD COLUMN {} {};'
+                           .format(table, column, type_))
+
+
+def column_exists(engine, schema, table, column):
+    return engine.execute(
+        text('SELECT 1 FROM information_schema.columns '
+             'WHERE table_schema = :schema AND table_name = :table '
+             'AND column_name = :column'),
+        schema=schema, table=table, column=column).first() is not None
 
 
 def main(argv=sys.argv):
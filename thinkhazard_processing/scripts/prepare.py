@@ -0,0 +1,25 @@
+import sys
+import argparse
+from sqlalchemy import engine_from_config
+from thinkhazard_common.models import DBSession
+from .. import settings
+from ..prepare import prepare
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--hazardset_id',  dest='hazardset_id', action='store',
+        help='The hazard set identifier')
+    parser.add_argument(
+        '--force', dest='force',
+        action='store_const', const=True, default=False,
+        help='Force execution even if layers have already been prepared')
+    args = parser.parse_args(argv[1:])
+
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+
+    prepare(
+        hazardset_id=args.hazardset_id,
+        force=args.force)
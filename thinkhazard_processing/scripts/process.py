@@ -3,6 +3,7 @@ import argparse
 from sqlalchemy import engine_from_config
 from thinkhazard_common.models import DBSession
 from .. import settings
+from ..metrics import profile
 from ..processing import process
 
 
@@ -14,12 +15,28 @@ def main(argv=sys.argv):
     parser.add_argument(
         '--force', dest='force',
         action='store_const', const=True, default=False,
-        help='Force execution even if hazardset has already been processed')
+        help='Force execution even if hazardset has already been processed, '
+             'unless its inputs did not change since')
+    parser.add_argument(
+        '--really-force', dest='really_force',
+        action='store_const', const=True, default=False,
+        help='Force execution even if the inputs of the hazardset did not '
+             'change since it has been processed')
+    parser.add_argument(
+        '--jobs', dest='jobs', action='store', type=int, default=1,
+        help='The number of worker processes, processing hazardsets '
+             'in parallel or sharing a single one')
+    parser.add_argument(
+        '--profile', dest='profile', action='store', metavar='FILE',
+        help='Dump the cProfile statistics of the run to FILE')
     args = parser.parse_args(argv[1:])
 
     engine = engine_from_config(settings, 'sqlalchemy.')
     DBSession.configure(bind=engine)
 
-    process(
-        hazardset_id=args.hazardset_id,
-        force=args.force)
+    with profile(args.profile):
+        process(
+            hazardset_id=args.hazardset_id,
+            force=args.force,
+            jobs=args.jobs,
+            really_force=args.really_force)
@@ -1,13 +1,16 @@
 import yaml
 from sqlalchemy import engine_from_config
-from .. import settings
+from .. import (
+    merge_settings,
+    settings,
+    )
 from ..scripts.initializedb import initdb_processing
 
 
 local_settings_path = 'local.tests.yaml'
 
 with open(local_settings_path, 'r') as f:
-    settings.update(yaml.load(f.read()))
+    merge_settings(settings, yaml.load(f.read()))
 
 
 def initdb():
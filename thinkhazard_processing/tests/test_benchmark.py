@@ -0,0 +1,36 @@
+import unittest
+from ..benchmark import (
+    division_grid,
+    division_polygon,
+    )
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_division_grid(self):
+        '''Test synthetic divisions are nested'''
+        divisions = division_grid(3, 2)
+        levels = [division[0] for division in divisions]
+        self.assertEqual(levels.count(u'COU'), 3)
+        self.assertEqual(levels.count(u'PRO'), 12)
+        self.assertEqual(levels.count(u'REG'), 48)
+
+        by_code = dict((division[1], division) for division in divisions)
+        self.assertEqual(len(by_code), len(divisions))
+        for level, code, parent_code, bounds in divisions:
+            if level == u'COU':
+                self.assertIsNone(parent_code)
+                continue
+            parent = by_code[parent_code]
+            self.assertEqual(parent[0],
+                             {u'PRO': u'COU', u'REG': u'PRO'}[level])
+            left, bottom, right, top = parent[3]
+            self.assertTrue(left <= bounds[0] < bounds[2] <= right)
+            self.assertTrue(bottom <= bounds[1] < bounds[3] <= top)
+
+    def test_division_polygon(self):
+        '''Test synthetic polygons cover their bounds'''
+        polygon = division_polygon((0, 0, 2, 1), 10)
+        self.assertTrue(polygon.is_valid)
+        self.assertEqual(len(polygon.exterior.coords), 41)
+        self.assertAlmostEqual(polygon.area, 2)
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from ..cache import MaskCache
+
+
+class TestMaskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_mask(self):
+        '''Test masks are restored with their shape'''
+        cache = MaskCache(self.path, 1024 * 1024)
+        mask = np.zeros((3, 5), dtype=np.uint8)
+        mask[1, 2:4] = 1
+        key = cache.key(1, 'hash', (0., 1.), (3, 5))
+        self.assertIsNone(cache.get_mask(key, (3, 5)))
+        cache.put_mask(key, mask)
+        np.testing.assert_array_equal(cache.get_mask(key, (3, 5)), mask)
+
+    def test_labels(self):
+        '''Test label rasters are stored with a small type'''
+        cache = MaskCache(self.path, 1024 * 1024)
+        labels = np.array([[0, 1], [2, 300]], dtype=np.int32)
+        cache.put_labels('labels', labels)
+        restored = cache.get_labels('labels')
+        self.assertEqual(restored.dtype, np.uint16)
+        np.testing.assert_array_equal(restored, labels)
+
+    def test_replace(self):
+        '''Test replaced entries are counted once'''
+        mask = np.ones((100, 80), dtype=np.uint8)
+        cache = MaskCache(self.path, 1024 * 1024)
+        cache.put_mask('a', mask)
+        size = cache.size
+        cache.put_mask('a', mask)
+        self.assertEqual(cache.size, size)
+        self.assertEqual(cache.size,
+                         os.path.getsize(os.path.join(self.path, 'a.npy')))
+
+    def test_evict(self):
+        '''Test least recently used entries are evicted'''
+        mask = np.ones((100, 80), dtype=np.uint8)
+        cache = MaskCache(self.path, 1024 * 1024)
+        cache.put_mask('a', mask)
+        size = cache.size
+        cache.max_size = int(size * 2.5)
+        cache.put_mask('b', mask)
+        # make "a" the most recently used entry
+        os.utime(os.path.join(self.path, 'b.npy'), (0, 0))
+        cache.get_mask('a', mask.shape)
+        cache.put_mask('c', mask)
+        self.assertIsNotNone(cache.get_mask('a', mask.shape))
+        self.assertIsNone(cache.get_mask('b', mask.shape))
+        self.assertIsNotNone(cache.get_mask('c', mask.shape))
@@ -3,21 +3,32 @@ import transaction
 from datetime import datetime
 from shapely.geometry import Polygon
 from geoalchemy2.shape import from_shape
+from sqlalchemy.orm.exc import NoResultFound
 from thinkhazard_common.models import (
     DBSession,
     AdministrativeDivision,
+    HazardCategory,
     HazardType,
     HazardLevel,
+    hazardcategory_administrativedivision_table,
     )
 from ..models import (
     HazardSet,
+    HazardSetProgress,
     Layer,
     Output,
+    OutputChange,
+    OutputStaging,
     )
+from ..decision_tree import process_outputs
 from common import new_geonode_id
 
 
 def populate():
+    DBSession.execute(hazardcategory_administrativedivision_table.delete())
+    DBSession.query(OutputChange).delete()
+    DBSession.query(OutputStaging).delete()
+    DBSession.query(HazardSetProgress).delete()
     DBSession.query(Output).delete()
     DBSession.query(AdministrativeDivision).delete()
     DBSession.query(Layer).delete()
@@ -380,7 +391,68 @@ def populate_processing():
     DBSession.flush()
 
 
+def hazardlevel(code, hazardtype):
+    hazardcategory = DBSession.query(HazardCategory) \
+        .join((AdministrativeDivision,
+               HazardCategory.administrativedivisions)) \
+        .join(HazardType) \
+        .filter(AdministrativeDivision.code == code) \
+        .filter(HazardType.mnemonic == hazardtype) \
+        .one()
+    return hazardcategory.hazardlevel.mnemonic
+
+
 class TestDecisionTree(unittest.TestCase):
 
     def setUp(self):
         populate()
+
+    def test_decision_tree(self):
+        '''Test the most relevant hazardset is selected'''
+        process_outputs()
+        self.assertEqual(hazardlevel(30, u'EQ'), u'HIG')
+        self.assertEqual(hazardlevel(30, u'FL'), u'NPR')
+        self.assertEqual(hazardlevel(31, u'EQ'), u'LOW')
+        self.assertEqual(hazardlevel(32, u'EQ'), u'LOW')
+        self.assertEqual(hazardlevel(33, u'EQ'), u'LOW')
+        self.assertEqual(hazardlevel(34, u'EQ'), u'LOW')
+        self.assertEqual(hazardlevel(35, u'EQ'), u'LOW')
+
+    def test_incremental(self):
+        '''Test only changed admindivs are updated'''
+        process_outputs()
+        hazardset2 = DBSession.query(HazardSet).get(u'hazardset2')
+        admin31 = DBSession.query(AdministrativeDivision) \
+            .filter(AdministrativeDivision.code == 31).one()
+        output = DBSession.query(Output) \
+            .filter(Output.hazardset_id == hazardset2.id) \
+            .filter(Output.admin_id == admin31.id).one()
+        output.hazardlevel = HazardLevel.get(u'HIG')
+        change = OutputChange()
+        change.hazardset = hazardset2
+        change.admin_id = admin31.id
+        DBSession.add(change)
+        DBSession.flush()
+
+        process_outputs(incremental=True)
+        self.assertEqual(hazardlevel(31, u'EQ'), u'HIG')
+        self.assertEqual(hazardlevel(30, u'EQ'), u'HIG')
+        self.assertEqual(hazardlevel(32, u'EQ'), u'LOW')
+        self.assertEqual(hazardlevel(20, u'EQ'), u'HIG')
+        self.assertEqual(DBSession.query(OutputChange).count(), 0)
+
+    def test_upscaling(self):
+        '''Test parents inherit the highest hazardlevel of their children'''
+        process_outputs()
+        self.assertEqual(hazardlevel(20, u'EQ'), u'HIG')
+        self.assertEqual(hazardlevel(10, u'EQ'), u'HIG')
+
+    def test_min_coverage(self):
+        '''Test outputs with a low coverage ratio are ignored'''
+        process_outputs(min_coverage=25)
+        self.assertEqual(hazardlevel(31, u'EQ'), u'LOW')
+        self.assertEqual(hazardlevel(35, u'EQ'), u'LOW')
+        # the only outputs of admin div (code 30) cover 10 and 11%
+        self.assertRaises(NoResultFound, hazardlevel, 30, u'EQ')
+        self.assertRaises(NoResultFound, hazardlevel, 30, u'FL')
+        self.assertEqual(hazardlevel(20, u'EQ'), u'LOW')
@@ -0,0 +1,146 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import transaction
+from BaseHTTPServer import (
+    BaseHTTPRequestHandler,
+    HTTPServer,
+    )
+from SocketServer import ThreadingMixIn
+from mock import patch
+from thinkhazard_common.models import DBSession
+from . import settings
+from ..models import (
+    HazardSet,
+    Layer,
+    )
+from ..download import download
+from . import test_process
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''Serve the files of the server, with Range requests support unless
+    the `ranges` attribute of the server is False.'''
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        start = 0
+        header = self.headers.get('Range')
+        if header is not None and self.server.ranges:
+            start = int(header[len('bytes='):].split('-')[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range',
+                                 'bytes */{}'.format(len(data)))
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestDownload(unittest.TestCase):
+
+    def setUp(self):
+        test_process.populate()
+        self.data_path = tempfile.mkdtemp()
+        self.settings = patch.dict(settings, {'data_path': self.data_path})
+        self.settings.start()
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.files = {}
+        self.server.requests = []
+        self.server.ranges = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        for layer in DBSession.query(Layer):
+            layer.downloaded = False
+            layer.download_url = '{}/{}.tif'.format(url, layer.name())
+            self.server.files['/{}.tif'.format(layer.name())] = \
+                os.urandom(3 * 1024 * 1024 + layer.return_period)
+        DBSession.query(HazardSet).one().complete = False
+        transaction.commit()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.settings.stop()
+        shutil.rmtree(self.data_path)
+
+    def data(self, layer):
+        return self.server.files['/{}.tif'.format(layer.name())]
+
+    def read(self, layer):
+        with open(layer.path(), 'rb') as f:
+            return f.read()
+
+    def test_download(self):
+        '''Test layers are downloaded and hazardsets completed'''
+        self.assertEqual(download(jobs=2), [])
+        for layer in DBSession.query(Layer):
+            self.assertTrue(layer.downloaded)
+            self.assertEqual(self.read(layer), self.data(layer))
+            self.assertFalse(os.path.exists(layer.path() + '.part'))
+        self.assertTrue(DBSession.query(HazardSet).one().complete)
+
+        # nothing left to download
+        del self.server.requests[:]
+        self.assertEqual(download(jobs=2), [])
+        self.assertEqual(self.server.requests, [])
+
+    def test_resume(self):
+        '''Test partial downloads are resumed with Range requests'''
+        layer = DBSession.query(Layer).first()
+        os.makedirs(os.path.dirname(layer.path()))
+        with open(layer.path() + '.part', 'wb') as f:
+            f.write(self.data(layer)[:1000])
+
+        self.assertEqual(download(jobs=2), [])
+        self.assertIn(('/{}.tif'.format(layer.name()), 'bytes=1000-'),
+                      self.server.requests)
+        self.assertEqual(self.read(layer), self.data(layer))
+
+    def test_no_ranges(self):
+        '''Test downloads start over when ranges are not supported'''
+        self.server.ranges = False
+        layer = DBSession.query(Layer).first()
+        os.makedirs(os.path.dirname(layer.path()))
+        with open(layer.path() + '.part', 'wb') as f:
+            f.write('garbage')
+
+        self.assertEqual(download(jobs=2), [])
+        self.assertEqual(self.read(layer), self.data(layer))
+
+    def test_failure(self):
+        '''Test failed downloads leave the hazardset incomplete'''
+        layer = DBSession.query(Layer).first()
+        del self.server.files['/{}.tif'.format(layer.name())]
+        name = layer.name()
+        path = layer.path()
+
+        self.assertEqual(download(jobs=2), [name])
+        for layer in DBSession.query(Layer):
+            self.assertEqual(layer.downloaded, layer.name() != name)
+        self.assertFalse(DBSession.query(HazardSet).one().complete)
+        self.assertFalse(os.path.exists(path))
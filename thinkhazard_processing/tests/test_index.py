@@ -0,0 +1,81 @@
+import unittest
+import transaction
+from shapely.geometry import (
+    MultiPolygon,
+    box,
+    )
+from geoalchemy2.shape import (
+    from_shape,
+    to_shape,
+    )
+from thinkhazard_common.models import (
+    DBSession,
+    AdministrativeDivision,
+    )
+from ..models import DivisionGeometry
+from ..index import (
+    DivisionIndex,
+    query_geometries,
+    refresh_division_geometries,
+    )
+from . import test_process
+
+
+class TestDivisionIndex(unittest.TestCase):
+
+    def setUp(self):
+        # one REG division covering 0/0/1/1
+        test_process.populate()
+        self.admin_id = DBSession.query(AdministrativeDivision.id) \
+            .filter(AdministrativeDivision.code == 30).scalar()
+
+    def test_inside(self):
+        '''Test divisions within the footprint need no exact test'''
+        index = DivisionIndex()
+        admin_ids, inside = index.candidates(box(-180, -90, 180, 90))
+        self.assertEqual(admin_ids, [self.admin_id])
+        self.assertEqual(inside, set([self.admin_id]))
+
+    def test_boundary(self):
+        '''Test divisions crossing the footprint are candidates'''
+        index = DivisionIndex()
+        admin_ids, inside = index.candidates(box(0.5, 0.5, 10, 10))
+        self.assertEqual(admin_ids, [self.admin_id])
+        self.assertEqual(inside, set())
+
+    def test_outside(self):
+        '''Test divisions out of the footprint are not candidates'''
+        index = DivisionIndex()
+        admin_ids, inside = index.candidates(box(2, 2, 10, 10))
+        self.assertEqual(admin_ids, [])
+        self.assertEqual(inside, set())
+
+    def test_refresh(self):
+        '''Test only new and changed geometries are transformed'''
+        self.assertEqual(refresh_division_geometries(), 1)
+        self.assertEqual(refresh_division_geometries(), 0)
+
+        admindiv = DBSession.query(AdministrativeDivision) \
+            .get(self.admin_id)
+        admindiv.geom = from_shape(
+            MultiPolygon([box(0, 0, 1000000, 1000000)]), 3857)
+        transaction.commit()
+        self.assertEqual(refresh_division_geometries(), 1)
+
+        geometry = DBSession.query(DivisionGeometry).get(self.admin_id)
+        self.assertAlmostEqual(geometry.maxx, 8.983, places=3)
+        self.assertAlmostEqual(to_shape(geometry.geom).bounds[3], 8.946,
+                               places=3)
+
+    def test_query_geometries(self):
+        '''Test only the geometries of the given divisions are streamed'''
+        refresh_division_geometries()
+        geometries = list(query_geometries([self.admin_id]))
+        self.assertEqual(len(geometries), 1)
+        admin_id, geometry = geometries[0]
+        self.assertEqual(admin_id, self.admin_id)
+        for value, expected in zip(geometry.bounds, (0, 0, 1, 1)):
+            self.assertAlmostEqual(value, expected)
+
+        self.assertEqual(list(query_geometries([self.admin_id + 1])), [])
+        self.assertEqual(list(query_geometries([])), [])
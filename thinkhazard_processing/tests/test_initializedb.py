@@ -0,0 +1,33 @@
+import unittest
+from sqlalchemy import engine_from_config
+from . import settings
+from ..scripts.initializedb import (
+    UPGRADE_COLUMNS,
+    column_exists,
+    initdb_processing,
+    )
+
+
+class TestInitializeDB(unittest.TestCase):
+
+    def test_upgrade(self):
+        '''Test the missing columns are added to the existing tables'''
+        engine = engine_from_config(settings, 'sqlalchemy.')
+        connection = engine.connect()
+        trans = connection.begin()
+        try:
+            for table, column, type_ in UPGRADE_COLUMNS:
+                connection.execute(
+                    'ALTER TABLE processing.{} DROP COLUMN {};'
+                    .format(table, column))
+                self.assertFalse(column_exists(connection, 'processing',
+                                               table, column))
+            initdb_processing(connection)
+            # and again, once the columns exist
+            initdb_processing(connection)
+            for table, column, type_ in UPGRADE_COLUMNS:
+                self.assertTrue(column_exists(connection, 'processing',
+                                              table, column))
+        finally:
+            trans.rollback()
+            connection.close()
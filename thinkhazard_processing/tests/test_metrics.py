@@ -0,0 +1,78 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from . import settings
+from ..metrics import (
+    SLOWEST_COUNT,
+    Metrics,
+    )
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_summary(self):
+        '''Test stages are summarized by counts, totals and percentiles'''
+        metrics = Metrics()
+        metrics.reset(u'test')
+        for i in range(1, 101):
+            metrics.add('read', i / 100.)
+        with metrics.stage('write'):
+            pass
+        summary = metrics.summary(divisions=3)
+        self.assertEqual(summary['name'], u'test')
+        self.assertEqual(summary['divisions'], 3)
+        read = summary['stages']['read']
+        self.assertEqual(read['count'], 100)
+        self.assertAlmostEqual(read['total'], 50.5)
+        self.assertAlmostEqual(read['p50'], 0.505)
+        self.assertAlmostEqual(read['max'], 1.)
+        self.assertEqual(summary['stages']['write']['count'], 1)
+
+    def test_slowest(self):
+        '''Test only the slowest divisions are kept, slowest first'''
+        metrics = Metrics()
+        for admin_id in range(100):
+            metrics.division(admin_id, admin_id % 50 / 10.)
+        slowest = metrics.summary()['slowest']
+        self.assertEqual(len(slowest), SLOWEST_COUNT)
+        self.assertEqual(slowest[0]['duration'], 4.9)
+        self.assertEqual(set(division['admin_id'] for division in slowest[:2]),
+                         set([49, 99]))
+
+    def test_merge(self):
+        '''Test the timings of another process are merged'''
+        worker = Metrics()
+        worker.add('read', 1.)
+        worker.division(1, 2.)
+        metrics = Metrics()
+        metrics.add('read', 3.)
+        metrics.merge(worker.state())
+        summary = metrics.summary()
+        self.assertEqual(summary['stages']['read']['count'], 2)
+        self.assertEqual(summary['stages']['read']['total'], 4.)
+        self.assertEqual(summary['slowest'],
+                         [{'admin_id': 1, 'duration': 2.}])
+
+    def test_write(self):
+        '''Test summaries are appended as JSON lines'''
+        metrics = Metrics()
+        metrics.add('read', 1.)
+        with patch.dict(settings, {'data_path': self.path}), \
+                patch.dict(settings['processing'],
+                           {'metrics_file': 'metrics.jsonl'}):
+            metrics.write(engine='zonal')
+            metrics.write(engine='window')
+        with open(os.path.join(self.path, 'metrics.jsonl')) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([line['engine'] for line in lines],
+                         ['zonal', 'window'])
+        self.assertEqual(lines[0]['stages']['read']['count'], 1)
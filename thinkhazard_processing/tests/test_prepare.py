@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import rasterio
+from mock import patch
+from thinkhazard_common.models import DBSession
+from . import settings
+from ..models import (
+    HazardSet,
+    Layer,
+    )
+from ..prepare import (
+    overview_factors,
+    prepare,
+    )
+from . import test_process
+
+
+def write_layer(path, data):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    height, width = data.shape
+    with rasterio.open(path, 'w', driver='GTiff', width=width, height=height,
+                       count=1, dtype=data.dtype.name) as dst:
+        dst.write(data, 1)
+
+
+class TestPrepare(unittest.TestCase):
+
+    def setUp(self):
+        test_process.populate()
+        self.data_path = tempfile.mkdtemp()
+        self.settings = patch.dict(settings, {'data_path': self.data_path})
+        self.settings.start()
+
+    def tearDown(self):
+        self.settings.stop()
+        shutil.rmtree(self.data_path)
+
+    def test_prepare(self):
+        '''Test layers are rewritten as tiled geotiffs'''
+        data = np.arange(300 * 200, dtype=np.float32).reshape(300, 200)
+        for layer in DBSession.query(Layer):
+            write_layer(layer.path(), data)
+
+        with patch.dict(settings['processing'], {'block_size': 128}):
+            prepare()
+
+        for layer in DBSession.query(Layer):
+            self.assertIsNotNone(layer.prepared_path)
+            self.assertEqual(layer.processing_path(), layer.prepared_path)
+            with rasterio.open(layer.prepared_path) as src:
+                self.assertEqual(src.block_shapes, [(128, 128)])
+                self.assertEqual(src.tags(ns='rio_overview'),
+                                 {'resampling': 'nearest'})
+                np.testing.assert_array_equal(src.read(1), data)
+
+    def test_overview_factors(self):
+        '''Test overviews are built until they fit in a block'''
+        self.assertEqual(overview_factors((300, 200), 128), [2])
+        self.assertEqual(overview_factors((20, 20), 256), [])
+        self.assertEqual(overview_factors((21600, 43200), 256),
+                         [2, 4, 8, 16, 32, 64, 128])
+
+    def test_outdated(self):
+        '''Test prepared files older than the layer are not processed'''
+        data = np.zeros((20, 20), dtype=np.uint8)
+        for layer in DBSession.query(Layer):
+            write_layer(layer.path(), data)
+        prepare()
+        layer = DBSession.query(Layer).first()
+        os.utime(layer.prepared_path, (0, 0))
+        self.assertEqual(layer.processing_path(), layer.path())
+
+    def test_prepare_outdated(self):
+        '''Test outdated prepared files are prepared again'''
+        data = np.zeros((20, 20), dtype=np.uint8)
+        for layer in DBSession.query(Layer):
+            write_layer(layer.path(), data)
+        prepare()
+
+        # downloaded again
+        for layer in DBSession.query(Layer):
+            write_layer(layer.path(), data + 1)
+            os.utime(layer.prepared_path, (0, 0))
+        prepare()
+
+        for layer in DBSession.query(Layer):
+            self.assertEqual(layer.processing_path(), layer.prepared_path)
+            with rasterio.open(layer.prepared_path) as src:
+                np.testing.assert_array_equal(src.read(1), data + 1)
+
+    def test_hazardlevels(self):
+        '''Test the hazard levels raster is written when layers change'''
+        data = np.array([[0., 1000.], [1000., 0.]], dtype=np.float32)
+        for layer in DBSession.query(Layer):
+            write_layer(layer.path(), data)
+        prepare()
+
+        hazardset = DBSession.query(HazardSet).one()
+        path = hazardset.hazardlevels_path()
+        with rasterio.open(path) as src:
+            # valid everywhere, positive in all the layers or in none
+            np.testing.assert_array_equal(src.read(1), [[7, 63], [63, 7]])
+
+        os.utime(path, (0, 0))
+        prepare()
+        self.assertEqual(os.path.getmtime(path), 0)
+
+        prepare(force=True)
+        self.assertNotEqual(os.path.getmtime(path), 0)
@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import unittest
 import transaction
 from datetime import datetime
@@ -16,18 +19,34 @@ from thinkhazard_common.models import (
     AdministrativeDivision,
     HazardType,
     HazardLevel,
+    hazardcategory_administrativedivision_table,
     )
 from . import settings
 from ..models import (
     HazardSet,
+    HazardSetProgress,
     Layer,
     Output,
+    OutputChange,
+    OutputStaging,
+    catalogue,
+    )
+from ..index import division_index
+from ..processing import (
+    VERSION,
+    ProcessException,
+    _process_hazardset_job,
+    process,
+    process_parallel,
     )
-from ..processing import process
 from common import new_geonode_id
 
 
 def populate():
+    DBSession.execute(hazardcategory_administrativedivision_table.delete())
+    DBSession.query(OutputChange).delete()
+    DBSession.query(OutputStaging).delete()
+    DBSession.query(HazardSetProgress).delete()
     DBSession.query(Output).delete()
     DBSession.query(Layer).delete()
     DBSession.query(HazardSet).delete()
@@ -44,14 +63,30 @@ def rasterio_open(reader):
     return mock
 
 
-def global_reader(value=None):
+def rasterio_open_layers(readers):
+    '''Return a side effect of rasterio.open opening the readers given by
+    return period, for the layers opened by several processes.'''
+    def open_layer(path):
+        return rasterio_open(
+            readers[int(os.path.splitext(os.path.basename(path))[0])])
+    return open_layer
+
+
+def global_reader(value=None, nodata=None):
     array = np.empty(shape=(360, 720), dtype=np.float32, order='C')
     if value is not None:
         array.fill(value)
+    if nodata is not None:
+        # nodata is a (rows, cols) tuple of slices
+        mask = np.zeros(array.shape, dtype=bool)
+        mask[nodata] = True
+        array = np.ma.masked_array(array, mask=mask)
     transform = Affine(-180., 0.5, 0.0, 90., 0.0, -0.5)
     reader = Mock(spec=RasterReader)
     reader.read.return_value = array
     reader.shape = array.shape
+    reader.dtypes = [array.dtype.name]
+    reader.block_shapes = [(1, array.shape[1])]
     reader.transform = transform
     reader.bounds = (-180., -90., 180., 90.)
     reader.window.return_value = ((0, 359), (0, 719))
@@ -63,6 +98,14 @@ class TestProcess(unittest.TestCase):
 
     def setUp(self):
         populate()
+        # the cache of rasterized divisions is stored in the data path
+        self.data_path = tempfile.mkdtemp()
+        self.settings = patch.dict(settings, {'data_path': self.data_path})
+        self.settings.start()
+
+    def tearDown(self):
+        self.settings.stop()
+        shutil.rmtree(self.data_path)
 
     @patch('rasterio.open')
     def test_process_nodata(self, open_mock):
@@ -114,6 +157,241 @@ class TestProcess(unittest.TestCase):
         output = DBSession.query(Output).first()
         self.assertEqual(output.hazardlevel.mnemonic, 'HIG')
 
+    @patch('rasterio.open')
+    def test_process_window_engine(self, open_mock):
+        '''Test value > threshold in MED layer with window engine'''
+        open_mock.side_effect = [
+            rasterio_open(global_reader()),
+            rasterio_open(global_reader(100.0)),
+            rasterio_open(global_reader())
+        ]
+        with patch.dict(settings['processing'], {'engine': 'window'}):
+            process(force=True)
+        output = DBSession.query(Output).first()
+        self.assertEqual(output.hazardlevel.mnemonic, 'MED')
+
+    @patch('rasterio.open')
+    def test_process_coverage(self, open_mock):
+        '''Test coverage ratio'''
+        ratios = []
+        for engine in ('zonal', 'window'):
+            open_mock.side_effect = [
+                rasterio_open(global_reader(100.0)),
+                rasterio_open(global_reader()),
+                rasterio_open(global_reader())
+            ]
+            with patch.dict(settings['processing'], {'engine': engine}):
+                process(force=True)
+            output = DBSession.query(Output).first()
+            self.assertEqual(output.coverage_ratio, 100)
+
+            # no data in a part of the pixels of the division
+            open_mock.side_effect = [
+                rasterio_open(global_reader(100.0, np.s_[5:, :])),
+                rasterio_open(global_reader()),
+                rasterio_open(global_reader())
+            ]
+            with patch.dict(settings['processing'], {'engine': engine}):
+                process(force=True)
+            output = DBSession.query(Output).first()
+            self.assertEqual(output.hazardlevel.mnemonic, 'HIG')
+            self.assertTrue(0 < output.coverage_ratio < 100)
+            ratios.append(output.coverage_ratio)
+        self.assertEqual(ratios[0], ratios[1])
+
+    @patch('rasterio.open')
+    def test_process_jobs(self, open_mock):
+        '''Test a hazardset shared between jobs gives the serial results'''
+        open_mock.side_effect = rasterio_open_layers({
+            250: global_reader(0.0, np.s_[5:, :]),
+            475: global_reader(100.0),
+            2475: global_reader(0.0)
+            })
+        for engine in ('zonal', 'window'):
+            results = []
+            for jobs in (1, 2):
+                with patch.dict(settings['processing'], {'engine': engine}):
+                    process(force=True, jobs=jobs)
+                output = DBSession.query(Output).one()
+                results.append((output.hazardlevel.mnemonic,
+                                output.coverage_ratio))
+            self.assertEqual(results[0][0], 'MED')
+            self.assertEqual(results[0], results[1])
+
+    @patch('rasterio.open')
+    def test_process_jobs_setup_failure(self, open_mock):
+        '''Test a failing setup of the workers fails the processing'''
+        parent = os.getpid()
+        open_layer = rasterio_open_layers({
+            250: global_reader(100.0),
+            475: global_reader(),
+            2475: global_reader()
+            })
+
+        def open_in_parent(path):
+            if os.getpid() != parent:
+                raise IOError('unreadable layer')
+            return open_layer(path)
+        open_mock.side_effect = open_in_parent
+
+        for engine in ('zonal', 'window'):
+            with patch.dict(settings['processing'], {'engine': engine}):
+                with self.assertRaises(ProcessException) as context:
+                    process(force=True, jobs=2)
+            transaction.abort()
+            self.assertIn('unreadable layer', context.exception.message)
+
+    @patch('rasterio.open', side_effect=IOError('unreadable layer'))
+    def test_process_hazardset_job(self, open_mock):
+        '''Test a failing job returns its traceback and rolls back'''
+        DBSession.query(HazardSet).one().processed = True
+        transaction.commit()
+
+        catalogue.load([u'test'])
+        try:
+            hazardset_id, error = _process_hazardset_job(
+                (u'test', True, False))
+        finally:
+            catalogue.invalidate()
+        self.assertEqual(hazardset_id, u'test')
+        self.assertIn('unreadable layer', error)
+        # the hazardset was set as not processed before the failure
+        self.assertTrue(DBSession.query(HazardSet).one().processed)
+
+    @patch('rasterio.open')
+    def test_process_parallel(self, open_mock):
+        '''Test a failing hazardset does not stop the other ones'''
+        populate_processing(u'broken')
+        transaction.commit()
+        open_layer = rasterio_open_layers({
+            250: global_reader(100.0),
+            475: global_reader(),
+            2475: global_reader()
+            })
+
+        def open_or_fail(path):
+            if u'broken' in path:
+                raise IOError('unreadable layer')
+            return open_layer(path)
+        open_mock.side_effect = open_or_fail
+
+        catalogue.load([u'test', u'broken'])
+        division_index.load()
+        try:
+            failed = process_parallel([u'test', u'broken'], force=True,
+                                      jobs=2)
+        finally:
+            catalogue.invalidate()
+            division_index.invalidate()
+        self.assertEqual(failed, [u'broken'])
+        output = DBSession.query(Output) \
+            .filter(Output.hazardset_id == u'test').one()
+        self.assertEqual(output.hazardlevel.mnemonic, 'HIG')
+        self.assertFalse(DBSession.query(HazardSet).get(u'broken').processed)
+
+    @patch('thinkhazard_processing.index.geometries_signature',
+           return_value='geometries')
+    @patch('thinkhazard_processing.processing.signature',
+           return_value='layers')
+    @patch('rasterio.open')
+    def test_process_resume(self, open_mock, signature_mock,
+                            geometries_mock):
+        '''Test resuming the processing from the staged results'''
+        admin_id = DBSession.query(AdministrativeDivision.id) \
+            .filter(AdministrativeDivision.code == 30).scalar()
+
+        def stage(signature):
+            progress = HazardSetProgress()
+            progress.hazardset_id = u'test'
+            progress.signature = signature
+            progress.processed = 1
+            progress.total = 1
+            DBSession.add(progress)
+            staging = OutputStaging()
+            staging.hazardset_id = u'test'
+            staging.admin_id = admin_id
+            staging.hazardlevel_id = HazardLevel.get(u'LOW').id
+            staging.coverage_ratio = 50
+            DBSession.add(staging)
+            transaction.commit()
+
+        for engine in ('zonal', 'window'):
+            # same inputs, the staged result is kept
+            stage('{}-layers-geometries'.format(VERSION))
+            open_mock.side_effect = [
+                rasterio_open(global_reader(100.0)),
+                rasterio_open(global_reader()),
+                rasterio_open(global_reader())
+            ]
+            with patch.dict(settings['processing'], {'engine': engine}):
+                process(force=True)
+            output = DBSession.query(Output).first()
+            self.assertEqual(output.hazardlevel.mnemonic, 'LOW')
+            self.assertEqual(output.coverage_ratio, 50)
+            self.assertEqual(DBSession.query(OutputStaging).count(), 0)
+            self.assertEqual(DBSession.query(HazardSetProgress).count(), 0)
+
+            # other inputs or an older version of the processing,
+            # the staged result is discarded
+            for other in ('other',
+                          '{}-layers-geometries'.format(VERSION - 1)):
+                stage(other)
+                open_mock.side_effect = [
+                    rasterio_open(global_reader(100.0)),
+                    rasterio_open(global_reader()),
+                    rasterio_open(global_reader())
+                ]
+                with patch.dict(settings['processing'], {'engine': engine}):
+                    process(force=True)
+                output = DBSession.query(Output).first()
+                self.assertEqual(output.hazardlevel.mnemonic, 'HIG')
+                self.assertEqual(output.coverage_ratio, 100)
+
+    @patch('rasterio.open')
+    def test_process_fingerprint(self, open_mock):
+        '''Test forced runs skip the hazardsets whose inputs did not change'''
+        os.makedirs(DBSession.query(HazardSet).one().path())
+        for layer in DBSession.query(Layer):
+            with open(layer.path(), 'wb') as f:
+                f.write(layer.name())
+        unit = layer.hazardunit
+
+        def run(**kwargs):
+            open_mock.reset_mock()
+            open_mock.side_effect = [
+                rasterio_open(global_reader(100.0)),
+                rasterio_open(global_reader()),
+                rasterio_open(global_reader())
+            ]
+            process(**kwargs)
+            return open_mock.call_count > 0
+
+        self.assertTrue(run(force=True))
+        fingerprint = DBSession.query(HazardSet).one().fingerprint
+        self.assertIsNotNone(fingerprint)
+
+        # same inputs
+        self.assertFalse(run(force=True))
+        self.assertTrue(run(really_force=True))
+        self.assertEqual(DBSession.query(HazardSet).one().fingerprint,
+                         fingerprint)
+
+        # other thresholds
+        thresholds = settings['hazard_types'][u'EQ']['thresholds']
+        with patch.dict(thresholds, {unit: thresholds[unit] + 1}):
+            self.assertTrue(run(force=True))
+            self.assertFalse(run(force=True))
+        self.assertTrue(run(force=True))
+
+        # other layer file
+        with open(layer.path(), 'ab') as f:
+            f.write('changed')
+        self.assertTrue(run(force=True))
+        self.assertFalse(run(force=True))
+        self.assertTrue(DBSession.query(HazardSet).one().processed)
+        self.assertEqual(DBSession.query(Output).first()
+                         .hazardlevel.mnemonic, 'HIG')
+
 
 def populate_datamart():
     print 'populate datamart'
@@ -148,9 +426,8 @@ def populate_datamart():
     DBSession.flush()
 
 
-def populate_processing():
+def populate_processing(hazardset_id=u'test'):
     print 'populate processing'
-    hazardset_id = u'test'
     hazardtype = HazardType.get(u'EQ')
     hazardtype_settings = settings['hazard_types'][hazardtype.mnemonic]
 
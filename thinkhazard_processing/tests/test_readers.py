@@ -0,0 +1,46 @@
+import unittest
+import numpy as np
+from mock import Mock, patch
+from rasterio._io import RasterReader
+from . import settings
+from ..readers import (
+    ArrayReader,
+    memory_reader,
+    )
+
+
+def reader(array):
+    src = Mock(spec=RasterReader)
+    src.read.return_value = array
+    src.shape = array.shape
+    src.dtypes = [array.dtype.name]
+    src.block_shapes = [(1, array.shape[1])]
+    return src
+
+
+class TestReaders(unittest.TestCase):
+
+    def test_array_reader(self):
+        '''Test windows are read as views of the array'''
+        array = np.ma.masked_array(np.arange(20, dtype=np.float32)
+                                   .reshape(4, 5))
+        array[0, 1] = np.ma.masked
+        src = reader(array)
+        memory = ArrayReader(src)
+        self.assertEqual(src.read.call_count, 1)
+
+        data = memory.read(1, window=((0, 2), (1, 3)), masked=True)
+        np.testing.assert_array_equal(data.data, [[1, 2], [6, 7]])
+        np.testing.assert_array_equal(data.mask, [[True, False],
+                                                  [False, False]])
+        self.assertFalse(data.data.flags.owndata)
+        self.assertFalse(data.data.flags.writeable)
+        self.assertEqual(src.read.call_count, 1)
+
+    def test_memory_reader(self):
+        '''Test only small rasters are read in memory'''
+        src = reader(np.zeros((1024, 1024), dtype=np.float32))
+        with patch.dict(settings['processing'], {'in_memory_size': 5}):
+            self.assertIsInstance(memory_reader(src, 'test'), ArrayReader)
+        with patch.dict(settings['processing'], {'in_memory_size': 4}):
+            self.assertIs(memory_reader(src, 'test'), src)
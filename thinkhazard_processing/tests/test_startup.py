@@ -0,0 +1,80 @@
+import os
+import sys
+import copy
+import subprocess
+import unittest
+from mock import patch
+from .. import (
+    Settings,
+    load_settings,
+    merge_settings,
+    )
+
+
+# run in a fresh interpreter, the modules of the tests are already imported
+SCRIPT = '''
+import sys
+import thinkhazard_processing.scripts.{}
+from thinkhazard_processing import settings
+print settings.loaded
+print ' '.join(name for name in ('rasterio', 'pyproj') if name in sys.modules)
+'''
+
+
+def imported(script):
+    root = os.path.join(os.path.dirname(__file__), '..', '..')
+    output = subprocess.check_output(
+        [sys.executable, '-c', SCRIPT.format(script)], cwd=root)
+    loaded, modules = output.split('\n')[:2]
+    return loaded == 'True', modules.split()
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_decision_tree(self):
+        '''Test the decision tree does not import the raster stack'''
+        loaded, modules = imported('decision_tree')
+        self.assertFalse(loaded)
+        self.assertEqual(modules, [])
+
+    def test_process(self):
+        '''Test the settings are not loaded when importing the scripts'''
+        loaded, modules = imported('process')
+        self.assertFalse(loaded)
+        self.assertIn('rasterio', modules)
+        self.assertNotIn('pyproj', modules)
+
+
+class TestSettings(unittest.TestCase):
+
+    def test_load(self):
+        '''Test the settings are loaded by any use of the mapping'''
+        expected = load_settings()
+        self.assertEqual(dict(Settings()), expected)
+        self.assertEqual(copy.copy(Settings()), expected)
+        self.assertEqual(len(Settings()), len(expected))
+        self.assertIn('data_path', Settings())
+
+    @patch('thinkhazard_processing.load_settings', side_effect=ValueError)
+    def test_load_failure(self, load_mock):
+        '''Test a failed load is attempted again on the next use'''
+        settings = Settings()
+        self.assertRaises(ValueError, settings.get, 'data_path')
+        self.assertFalse(settings.loaded)
+
+        load_mock.side_effect = None
+        load_mock.return_value = {'data_path': '/tmp'}
+        self.assertEqual(settings['data_path'], '/tmp')
+        self.assertTrue(settings.loaded)
+
+    def test_merge(self):
+        '''Test the local settings are merged key by key in the sections'''
+        settings = {'data_path': '/tmp',
+                    'processing': {'engine': 'auto', 'memory_limit': 512}}
+        merge_settings(settings, {'data_path': '/data',
+                                  'processing': {'engine': 'window'}})
+        self.assertEqual(settings, {
+            'data_path': '/data',
+            'processing': {'engine': 'window', 'memory_limit': 512}})
+        merge_settings(settings, None)
+        self.assertEqual(settings['data_path'], '/data')
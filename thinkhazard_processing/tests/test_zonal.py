@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import rasterio
+from affine import Affine
+from mock import patch
+from shapely.geometry import box
+from .. import settings
+from ..levels import read_flags
+from ..zonal import (
+    HAZARDLEVEL_CODES,
+    evaluate,
+    open_layers,
+    stream_windows,
+    zonal_admindivs,
+    )
+
+
+def write_layer(path, data):
+    # 1 degree pixels covering 0, 0, 10, 10, by blocks of one row so that
+    # the grid may be streamed by several windows
+    height, width = data.shape
+    with rasterio.open(path, 'w', driver='GTiff', width=width, height=height,
+                       count=1, dtype=data.dtype.name,
+                       crs={'init': 'epsg:4326'},
+                       transform=Affine(1., 0., 0., 0., -1., 10.),
+                       nodata=-9999., blockysize=1) as dst:
+        dst.write(data, 1)
+
+
+class TestEvaluate(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        hig = np.zeros((10, 10), dtype=np.float32)
+        hig[:, :5] = 100
+        # no data in the two bottom rows
+        hig[8:, :] = -9999
+        med = np.zeros((10, 10), dtype=np.float32)
+        low = np.full((10, 10), 100, dtype=np.float32)
+        self.paths = {}
+        for level, data in ((u'HIG', hig), (u'MED', med), (u'LOW', low)):
+            self.paths[level] = os.path.join(self.path,
+                                             '{}.tif'.format(level))
+            write_layer(self.paths[level], data)
+        self.thresholds = {u'HIG': 50, u'MED': 50, u'LOW': 50}
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_evaluate(self):
+        '''Test hazard levels are evaluated without database'''
+        divisions = [
+            (1, box(0.5, 5.5, 3.5, 8.5)),
+            (2, box(6.5, 5.5, 9.5, 8.5)),
+            (3, box(6.5, 0.5, 9.5, 3.5)),
+            (4, box(20, 20, 21, 21)),
+            ]
+        for engine in ('zonal', 'window'):
+            results = evaluate(iter(divisions), self.paths, self.thresholds,
+                               engine)
+            self.assertEqual(results['id'].tolist(), [1, 2, 3, 4])
+            self.assertEqual(
+                [HAZARDLEVEL_CODES[code] for code in results['hazardlevel']],
+                [u'HIG', u'LOW', u'LOW', None])
+            self.assertEqual(results['coverage'].tolist(), [100, 100, 50, 0])
+
+    def test_edge(self):
+        '''Test the part of a division outside the grid is not covered'''
+        # half of the division is outside the grid
+        divisions = [(1, box(8.5, 2.5, 11.5, 3.5))]
+        for engine in ('zonal', 'window'):
+            results = evaluate(divisions, self.paths, self.thresholds,
+                               engine)
+            self.assertEqual(HAZARDLEVEL_CODES[results['hazardlevel'][0]],
+                             u'LOW')
+            self.assertEqual(results['coverage'][0], 50)
+
+    def test_bands(self):
+        '''Test the zonal engine yields the divisions band after band'''
+        divisions = [
+            (1, box(0.5, 5.5, 3.5, 8.5)),
+            (2, box(6.5, 5.5, 9.5, 8.5)),
+            (3, box(6.5, 0.5, 9.5, 3.5)),
+            (4, box(20, 20, 21, 21)),
+            ]
+        # one window per row
+        with patch.dict(settings['processing'], {'memory_limit': 0.00001}), \
+                patch('thinkhazard_processing.zonal.read_flags',
+                      wraps=read_flags) as read:
+            with rasterio.drivers():
+                with open_layers(self.paths) as readers:
+                    results = zonal_admindivs(iter(divisions), readers,
+                                              self.thresholds)
+                    self.assertEqual(next(results), (4, None, None))
+                    self.assertEqual(next(results), (1, u'HIG', 100))
+                    # division 1 touches the six first rows
+                    self.assertEqual(read.call_count, 6)
+                    self.assertEqual(list(results),
+                                     [(2, u'LOW', 100), (3, u'LOW', 50)])
+                    self.assertEqual(read.call_count, 10)
+
+    def test_stream_windows(self):
+        '''Test the windows of the zonal engine fit in the memory limit'''
+        with rasterio.drivers():
+            with open_layers(self.paths) as readers:
+                for limit, label_count in ((0.0005, 1), (0.001, 3),
+                                           (0.002, 2)):
+                    with patch.dict(settings['processing'],
+                                    {'memory_limit': limit}):
+                        windows = stream_windows(readers, label_count)
+                    # the flags, an array of booleans, the int32 labels it
+                    # selects and their intp copy, plus the int32 labels
+                    pixel_size = 1 + 1 + 4 + np.dtype(np.intp).itemsize + \
+                        4 * label_count
+                    sizes = [(rows[1] - rows[0]) * (cols[1] - cols[0])
+                             for rows, cols in windows]
+                    self.assertEqual(sum(sizes), 100)
+                    self.assertGreater(max(sizes), 10)
+                    self.assertLessEqual(max(sizes) * pixel_size,
+                                         limit * 1024 * 1024)
+
+    def test_empty(self):
+        '''Test no divisions give an empty array'''
+        results = evaluate([], self.paths, self.thresholds, 'window')
+        self.assertEqual(len(results), 0)
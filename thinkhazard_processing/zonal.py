@@ -0,0 +1,743 @@
+# -*- coding: utf-8 -*-
+'''Evaluation of the hazard levels of divisions from the three layers of a
+hazardset, without database.
+
+The divisions are given as (id, geometry) tuples, the geometries being in
+the CRS of the layers, and the thresholds as values per level (HIG, MED
+and LOW). The engines yield (id, hazard level mnemonic, coverage ratio)
+tuples, see process_admindivs and zonal_admindivs, and `evaluate` gathers
+them in a compact array::
+
+    from thinkhazard_processing.zonal import evaluate, HAZARDLEVEL_CODES
+    results = evaluate(divisions,
+                       {'HIG': 'hig.tif', 'MED': 'med.tif', 'LOW': 'low.tif'},
+                       {'HIG': 98.0665, 'MED': 98.0665, 'LOW': 98.0665})
+'''
+
+import fractions
+import hashlib
+import math
+import time
+import numpy
+import rasterio
+from rasterio import features
+from shapely.ops import cascaded_union
+from shapely.geometry import Polygon
+from contextlib import contextmanager
+
+from . import settings
+from .metrics import metrics
+from .levels import (
+    POSITIVE_FLAGS,
+    VALID_FLAGS,
+    read_flags,
+    same_grid,
+    split_flags,
+    )
+from .readers import (
+    memory_reader,
+    memory_readers,
+    )
+
+
+# hazard levels by code in the arrays computed by the zonal engine,
+# code 0 stands for divisions not covered by the hazardset
+HAZARDLEVEL_CODES = (None, u'VLO', u'LOW', u'MED', u'HIG')
+
+# type of the arrays returned by evaluate
+RESULT_DTYPE = numpy.dtype([
+    ('id', numpy.int64),
+    ('hazardlevel', numpy.uint8),
+    ('coverage', numpy.uint8),
+    ])
+
+
+def evaluate(divisions, paths, thresholds, engine='auto', levels_path=None,
+             cache=None):
+    '''Return the hazard levels of the given (id, geometry) tuples of
+    divisions, for the layers whose paths are given per level.
+
+    The result is an array of RESULT_DTYPE, in the order of the divisions:
+    the hazard level is the code of the level in HAZARDLEVEL_CODES, 0 for
+    divisions which are not covered by the layers, and the coverage is the
+    percentage of the division covered by data in the HIG layer, see
+    coverage_ratios.
+
+    `engine` is one of the engines of select_engine. When `levels_path` is
+    given, the hazard levels raster at this path (see levels.py) is read
+    instead of the layers, it must be up to date. `cache` is an optional
+    cache.MaskCache.'''
+    divisions = list(divisions)
+    with rasterio.drivers():
+        with open_layers(paths) as readers, \
+                open_raster(levels_path) as levels:
+            engine = select_engine(engine, readers)
+            if levels is not None:
+                levels = memory_reader(levels, 'hazard levels raster')
+            else:
+                readers = memory_readers(readers)
+            results = results_array(evaluate_readers(
+                divisions, readers, thresholds, engine, cache=cache,
+                levels=levels))
+    # back to the order of the divisions, see evaluate_readers
+    positions = dict((division[0], i) for i, division in enumerate(divisions))
+    return results[numpy.argsort([positions[admin_id]
+                                  for admin_id in results['id']])]
+
+
+def evaluate_readers(divisions, readers, thresholds, engine, polygon=None,
+                     cache=None, inside=frozenset(), levels=None):
+    '''Yield the (id, hazard level mnemonic, coverage ratio) tuples of the
+    divisions with the given engine, zonal or window, from open readers.
+    The window engine yields them in the order of the divisions, the zonal
+    one as they complete.
+    See process_admindivs for `polygon` and `inside`, it defaults to the
+    footprint of the readers.'''
+    if engine == 'zonal':
+        return zonal_admindivs(divisions, readers, thresholds, cache, levels)
+    if polygon is None:
+        polygon = readers_polygon(readers)
+    return process_admindivs(divisions, readers, thresholds, polygon, cache,
+                             inside, levels)
+
+
+def results_array(results):
+    '''Gather (id, hazard level mnemonic, coverage ratio) tuples in an
+    array of RESULT_DTYPE.'''
+    rows = [(division_id,
+             HAZARDLEVEL_CODES.index(hazardlevel),
+             coverage_ratio or 0)
+            for division_id, hazardlevel, coverage_ratio in results]
+    return numpy.array(rows, dtype=RESULT_DTYPE)
+
+
+@contextmanager
+def open_layers(paths):
+    '''Open the layers whose paths are given per level, and yield their
+    readers per level.'''
+    with rasterio.open(paths['HIG']) as src_hig, \
+            rasterio.open(paths['MED']) as src_med, \
+            rasterio.open(paths['LOW']) as src_low:
+        readers = {}
+        readers['HIG'] = src_hig
+        readers['MED'] = src_med
+        readers['LOW'] = src_low
+        yield readers
+
+
+@contextmanager
+def open_raster(path=None):
+    '''Open the raster at `path` and yield its reader, or yield None if
+    `path` is None.'''
+    if path is None:
+        yield None
+        return
+    with rasterio.open(path) as src:
+        yield src
+
+
+def readers_polygon(readers):
+    return cascaded_union([polygonFromBounds(readers[level].bounds)
+                           for level in (u'HIG', u'MED', u'LOW')])
+
+
+def process_admindivs(admindivs, readers, thresholds, polygon,
+                      cache=None, inside=frozenset(), levels=None):
+    '''Yield the (admin id, hazard level mnemonic, coverage ratio) tuples
+    for the given (admin id, geometry in EPSG:4326) tuples of administrative
+    divisions. The hazard level and the coverage ratio are None for
+    divisions which are not covered by the hazardset.
+
+    The divisions whose ids are in `inside` are known to intersect the
+    footprint of the hazardset (`polygon`), they are not tested again.
+
+    When the hazard levels raster of the hazardset is given (`levels`), it
+    is read instead of the three layers.'''
+    shared_grid = same_grid(readers)
+
+    for admin_id, geometry in admindivs:
+        start = time.time()
+        key = None
+        if cache is not None:
+            key = (admin_id, geometry_hash(geometry))
+
+        footprint = None if admin_id in inside else polygon
+        if levels is not None:
+            hazardlevel, coverage_ratio = admindiv_hazardlevel_flags(
+                geometry, levels, footprint, cache, key)
+        else:
+            hazardlevel, coverage_ratio = admindiv_hazardlevel(
+                geometry, readers, thresholds, footprint,
+                cache, key, shared_grid)
+        metrics.division(admin_id, time.time() - start)
+        yield admin_id, hazardlevel, coverage_ratio
+
+
+def geometry_hash(geometry):
+    return hashlib.sha1(geometry.wkb).hexdigest()
+
+
+def division_mask(geometry, shape, transform, cache=None, key=None):
+    '''Rasterize the geometry with the all_touched semantics. When a cache
+    is given, `key` identifies the geometry in the cache.'''
+    with metrics.stage('rasterize'):
+        if cache is not None:
+            cache_key = cache.key(key, tuple(transform), tuple(shape))
+            mask = cache.get_mask(cache_key, shape)
+            if mask is not None:
+                return mask
+
+        mask = features.rasterize(
+            ((g, 1) for g in [geometry]),
+            out_shape=shape,
+            transform=transform,
+            all_touched=True)
+
+        if cache is not None:
+            cache.put_mask(cache_key, mask)
+        return mask
+
+
+def admindiv_hazardlevel(reprojected, readers, thresholds, polygon,
+                         cache=None, key=None, shared_grid=False):
+    '''Return the mnemonic of the hazard level of a division and its
+    coverage ratio, or (None, None) if the division is not covered by the
+    hazardset. The division is first tested against the footprint of the
+    hazardset (`polygon`), unless it is None. When the layers share the
+    same grid (`shared_grid`), the window and the mask of the division are
+    computed once and reused for the three levels.
+
+    The coverage ratio is measured on the first layer read, HIG, from the
+    mask of the division and the NO-DATA mask of the layer, see
+    coverage_ratios.'''
+    hazardlevel = None
+    coverage_ratio = None
+
+    if polygon is not None and not reprojected.intersects(polygon):
+        return hazardlevel, coverage_ratio
+
+    window = None
+    outside = None
+    for level in (u'HIG', u'MED', u'LOW'):
+        src = readers[level]
+
+        if window is None or not shared_grid:
+            window = src.window(*reprojected.bounds)
+            outside = None
+        with metrics.stage('read'):
+            data = src.read(1, window=window, masked=True)
+        if data.shape[0] * data.shape[1] == 0:
+            continue
+
+        with metrics.stage('threshold'):
+            positive_data = (data > thresholds[level]).astype(rasterio.uint8)
+
+        if outside is None:
+            division = division_mask(reprojected, data.shape,
+                                     src.window_transform(window),
+                                     cache, key)
+            outside = ~division.astype(bool)
+
+        with metrics.stage('reduce'):
+            masked = numpy.ma.masked_array(positive_data, mask=outside)
+
+            if coverage_ratio is None:
+                inside = ~outside
+                covered = inside & ~numpy.ma.getmaskarray(data)
+                coverage_ratio = int(coverage_ratios(
+                    [numpy.count_nonzero(covered)],
+                    [numpy.count_nonzero(inside)],
+                    [inside_fraction(reprojected, src.bounds)])[0])
+
+            maximum = numpy.max(masked)
+
+        if str(maximum) == str(numpy.ma.masked):
+            break
+        else:
+            if hazardlevel is None:
+                hazardlevel = u'VLO'
+
+        if maximum > 0:
+            hazardlevel = level
+            break
+
+    if hazardlevel is None:
+        coverage_ratio = None
+    return hazardlevel, coverage_ratio
+
+
+def admindiv_hazardlevel_flags(geometry, levels, polygon, cache=None,
+                               key=None):
+    '''Like admindiv_hazardlevel, from the hazard levels raster of the
+    hazardset, with a single read.'''
+    if polygon is not None and not geometry.intersects(polygon):
+        return None, None
+
+    window = levels.window(*geometry.bounds)
+    with metrics.stage('read'):
+        flags = levels.read(1, window=window)
+    if flags.shape[0] * flags.shape[1] == 0:
+        return None, None
+
+    division = division_mask(geometry, flags.shape,
+                             levels.window_transform(window),
+                             cache, key)
+    with metrics.stage('reduce'):
+        inside = division.astype(bool)
+        division_flags = numpy.bitwise_or.reduce(flags[inside]) \
+            if inside.any() else 0
+        code = hazardlevel_codes(*split_flags(
+            numpy.array([division_flags], dtype=numpy.uint8)))[0]
+        if code == 0:
+            return None, None
+
+        covered = inside & ((flags & VALID_FLAGS[u'HIG']) != 0)
+        coverage_ratio = coverage_ratios(
+            [numpy.count_nonzero(covered)],
+            [numpy.count_nonzero(inside)],
+            [inside_fraction(geometry, levels.bounds)])[0]
+    return HAZARDLEVEL_CODES[code], int(coverage_ratio)
+
+
+def coverage_ratios(covered, total, fractions=None):
+    '''Return the percentages of divisions which are covered by data, as
+    an array of integers ranging from 0 to 100, given the numbers of
+    covered pixels and of pixels of the divisions in the grid.
+
+    The pixels only count the part of the divisions inside the grid, the
+    part outside is not covered: the ratios are scaled by the `fractions`
+    of the areas of the divisions inside the grid, see inside_fraction.'''
+    covered = numpy.asarray(covered, dtype=numpy.float64)
+    total = numpy.asarray(total, dtype=numpy.float64)
+    if fractions is not None:
+        covered = covered * numpy.asarray(fractions, dtype=numpy.float64)
+    ratios = numpy.zeros(len(total), dtype=numpy.uint8)
+    nonempty = total > 0
+    ratios[nonempty] = numpy.rint(100 * covered[nonempty] / total[nonempty])
+    return ratios
+
+
+def inside_fraction(geometry, bounds):
+    '''Return the fraction of the area of the geometry inside the given
+    bounds of a grid, 1 for geometries without area.'''
+    minx, miny, maxx, maxy = geometry.bounds
+    if minx >= bounds[0] and miny >= bounds[1] and \
+            maxx <= bounds[2] and maxy <= bounds[3]:
+        return 1.
+    if geometry.area == 0:
+        return 1.
+    return geometry.intersection(polygonFromBounds(bounds)).area / \
+        geometry.area
+
+
+def select_engine(engine, readers, local=False):
+    '''Return the name of the engine used to compute the hazard levels of
+    the divisions:
+     * window: one windowed read and rasterization per division and level,
+     * zonal: see zonal_admindivs, requires the layers to share a grid,
+     * auto: zonal for global hazardsets and for layers too large to be
+       read by windows, window for the local ones (`local`).'''
+    if engine == 'window':
+        return engine
+    if not same_grid(readers):
+        if engine == 'zonal':
+            print '  layers do not share the same grid, using window engine'
+        return 'window'
+    if engine == 'auto' and local and not large_layers(readers):
+        return 'window'
+    return 'zonal'
+
+
+def large_layers(readers):
+    '''Tell whether any of the layers is larger than the
+    processing.memory_limit setting, in which case reading large divisions
+    by windows may not fit in memory.'''
+    limit = settings['processing']['memory_limit'] * 1024 * 1024
+    for src in readers.values():
+        height, width = src.shape
+        if height * width * numpy.dtype(src.dtypes[0]).itemsize > limit:
+            return True
+    return False
+
+
+def zonal_admindivs(admindivs, readers, thresholds, cache=None, levels=None):
+    '''Yield the (admin id, hazard level mnemonic, coverage ratio) tuples
+    for the given (admin id, geometry) tuples, like process_admindivs does.
+
+    Instead of reading and rasterizing a window per division and level,
+    the divisions are burnt into label rasters aligned to the grid shared
+    by the three layers. Each layer is then read only once and reduced per
+    label with vectorized operations.
+
+    The grid is streamed by windows made of whole native blocks of the
+    layers, so that each block is read exactly once per layer, and the
+    memory used stays under the processing.memory_limit setting. The flags
+    of the divisions are updated incrementally band of windows after band
+    of windows, see ZonalDivisions, and so are their pixel counts, from
+    which the coverage ratios are computed. The results of the divisions
+    are yielded as soon as the last band they touch has been reduced.
+
+    When the hazard levels raster of the hazardset is given (`levels`), it
+    is read instead of the three layers.'''
+    divisions = ZonalDivisions(admindivs, readers, cache)
+    # divisions out of the grid first
+    for result in divisions.finished(0):
+        yield result
+    for band in divisions.bands():
+        divisions.merge(divisions.reduce(readers, thresholds, band, cache,
+                                         levels))
+        for result in divisions.finished(band[0][0][1]):
+            yield result
+
+
+class ZonalDivisions(object):
+    '''The divisions evaluated by the zonal engine, with their label colors
+    and pixel boxes in the grid, the windows streamed over the grid, and
+    the flags and pixel counts of the divisions accumulated so far.
+
+    The windows are reduced by bands of rows, from top to bottom, and the
+    divisions whose boxes end above the last reduced row are complete, see
+    finished. The bands may be reduced by other processes, their partial
+    results being merged here in order, see stream_windows for `jobs`.'''
+
+    def __init__(self, admindivs, readers, cache=None, jobs=1):
+        self.admin_ids = []
+        self.geometries = []
+        self.keys = [] if cache is not None else None
+        for admin_id, geometry in admindivs:
+            self.admin_ids.append(admin_id)
+            self.geometries.append(geometry)
+            if cache is not None:
+                self.keys.append((admin_id, geometry_hash(geometry)))
+
+        src = readers[u'HIG']
+        height, width = src.shape
+        grid_transform = src.window_transform(((0, height), (0, width)))
+        self.bounds = src.bounds
+
+        with metrics.stage('rasterize'):
+            boxes = pixel_boxes(self.geometries, (height, width),
+                                grid_transform)
+            self.colors = color_boxes(boxes)
+        # boxes as arrays to select the divisions of each window,
+        # divisions out of the grid get an empty box
+        self.boxes = numpy.array([box or (0, 0, 0, 0) for box in boxes],
+                                 dtype=numpy.int64).reshape(-1, 4)
+        # divisions by last row, to yield them as soon as they are complete
+        self.order = numpy.argsort(self.boxes[:, 1], kind='mergesort')
+        self.yielded = 0
+
+        count = len(self.geometries)
+        self.valid = {}
+        self.positive = {}
+        for level in (u'HIG', u'MED', u'LOW'):
+            self.valid[level] = numpy.zeros(count, dtype=bool)
+            self.positive[level] = numpy.zeros(count, dtype=bool)
+        # pixels of the divisions, and those covered by data in the HIG layer
+        self.total = numpy.zeros(count, dtype=numpy.int64)
+        self.covered = numpy.zeros(count, dtype=numpy.int64)
+
+        self.windows = stream_windows(
+            readers, max(self.colors) + 1 if self.colors else 0, jobs)
+        if self.windows:
+            print '  streaming {} windows of {}x{} pixels'.format(
+                len(self.windows),
+                self.windows[0][0][1] - self.windows[0][0][0],
+                self.windows[0][1][1] - self.windows[0][1][0])
+
+    def bands(self):
+        '''Return the lists of the windows sharing the same rows, from top
+        to bottom.'''
+        bands = []
+        for window in self.windows:
+            if bands and bands[-1][0][0] == window[0]:
+                bands[-1].append(window)
+            else:
+                bands.append([window])
+        return bands
+
+    def reduce(self, readers, thresholds, windows, cache=None, levels=None):
+        '''Read and reduce the given windows. Return the partial result to
+        be merged: the indices of the divisions met, and for each one its
+        pixel counts and flags in these windows.'''
+        src = readers[u'HIG']
+        partial = {'indices': [], 'total': [], 'covered': []}
+        for level in (u'HIG', u'MED', u'LOW'):
+            partial[('valid', level)] = []
+            partial[('positive', level)] = []
+
+        for window in windows:
+            (row_start, row_stop), (col_start, col_stop) = window
+            boxes = self.boxes
+            selected = numpy.nonzero(
+                (boxes[:, 0] < row_stop) & (row_start < boxes[:, 1]) &
+                (boxes[:, 2] < col_stop) & (col_start < boxes[:, 3]))[0]
+            if len(selected) == 0:
+                # no division here, blocks do not even need to be read
+                continue
+
+            with metrics.stage('rasterize'):
+                labels = label_rasters(
+                    [self.geometries[i] for i in selected],
+                    [self.colors[i] for i in selected],
+                    (row_stop - row_start, col_stop - col_start),
+                    src.window_transform(window),
+                    cache,
+                    [self.keys[i] for i in selected]
+                    if cache is not None else None)
+
+            flags = read_flags(readers, thresholds, window, levels)
+            with metrics.stage('reduce'):
+                count = len(selected)
+                partial['indices'].append(selected)
+                partial['total'].append(labels_count(labels, None, count))
+                # a single array of booleans at a time, see stream_windows
+                for level in (u'HIG', u'MED', u'LOW'):
+                    pixels = (flags & VALID_FLAGS[level]) != 0
+                    if level == u'HIG':
+                        covered = labels_count(labels, pixels, count)
+                        partial['covered'].append(covered)
+                        partial[('valid', level)].append(covered > 0)
+                    else:
+                        partial[('valid', level)].append(
+                            labels_any(labels, pixels, count))
+                    del pixels
+                    pixels = (flags & POSITIVE_FLAGS[level]) != 0
+                    partial[('positive', level)].append(
+                        labels_any(labels, pixels, count))
+                    del pixels
+                del flags, labels
+
+        for key, arrays in partial.items():
+            partial[key] = numpy.concatenate(arrays) if arrays \
+                else numpy.zeros(0, dtype=numpy.int64)
+        return partial
+
+    def merge(self, partial):
+        '''Add the partial result of reduce to the flags and pixel counts of
+        the divisions.'''
+        indices = partial['indices']
+        numpy.add.at(self.total, indices, partial['total'])
+        numpy.add.at(self.covered, indices, partial['covered'])
+        for level in (u'HIG', u'MED', u'LOW'):
+            self.valid[level][
+                indices[partial[('valid', level)].astype(bool)]] = True
+            self.positive[level][
+                indices[partial[('positive', level)].astype(bool)]] = True
+
+    def finished(self, row):
+        '''Return the (admin id, hazard level mnemonic, coverage ratio)
+        tuples of the divisions not returned yet which are complete once the
+        rows above `row` have been merged.'''
+        stop = numpy.searchsorted(self.boxes[self.order, 1], row,
+                                  side='right')
+        indices = self.order[self.yielded:stop]
+        self.yielded = max(self.yielded, stop)
+        if len(indices) == 0:
+            return []
+
+        with metrics.stage('reduce'):
+            codes = hazardlevel_codes(
+                dict((level, self.valid[level][indices])
+                     for level in (u'HIG', u'MED', u'LOW')),
+                dict((level, self.positive[level][indices])
+                     for level in (u'HIG', u'MED', u'LOW')))
+            ratios = coverage_ratios(
+                self.covered[indices], self.total[indices],
+                [inside_fraction(self.geometries[i], self.bounds)
+                 for i in indices])
+        results = []
+        for i, code, ratio in zip(indices, codes, ratios):
+            if code == 0:
+                results.append((self.admin_ids[i], None, None))
+            else:
+                results.append((self.admin_ids[i], HAZARDLEVEL_CODES[code],
+                                int(ratio)))
+        return results
+
+
+def stream_windows(readers, label_count, jobs=1):
+    '''Return the windows streamed by the zonal engine, row by row. Windows
+    are made of whole native blocks of the layers and cover the grid. Each
+    one is small enough for its data, masks and `label_count` label rasters
+    to fit in the processing.memory_limit setting (in MB), shared between
+    the `jobs` processes reading windows at the same time.'''
+    src = readers[u'HIG']
+    height, width = src.shape
+    block_height = 1
+    block_width = 1
+    itemsize = 1
+    for reader in readers.values():
+        block_height = lcm(block_height, reader.block_shapes[0][0])
+        block_width = lcm(block_width, reader.block_shapes[0][1])
+        itemsize = max(itemsize, numpy.dtype(reader.dtypes[0]).itemsize)
+
+    # bytes per pixel at the peak of the reduction of a window: the int32
+    # labels, the uint8 flags, and either the data, the mask, the valid
+    # and the positive booleans of a layer while the flags are computed
+    # (see levels.layers_flags), or a boolean array, the int32 labels it
+    # selects and their intp copy by numpy.bincount while the flags are
+    # reduced (see labels_count)
+    pixel_size = 4 * label_count + 1 + \
+        max(itemsize + 3, 1 + 4 + numpy.dtype(numpy.intp).itemsize)
+    limit = int(settings['processing']['memory_limit'] * 1024 * 1024 / jobs)
+    max_pixels = max(1, limit // pixel_size)
+
+    if block_height * width <= max_pixels:
+        # whole rows of blocks
+        window_width = width
+        window_height = max(1, max_pixels // (block_height * width)) * \
+            block_height
+    else:
+        window_height = block_height
+        window_width = max(1, max_pixels // (block_height * block_width)) * \
+            block_width
+
+    windows = []
+    for row in range(0, height, window_height):
+        for col in range(0, width, window_width):
+            windows.append(((row, min(row + window_height, height)),
+                            (col, min(col + window_width, width))))
+    return windows
+
+
+def lcm(a, b):
+    return a * b // fractions.gcd(a, b)
+
+
+def label_rasters(geometries, colors, shape, transform, cache=None,
+                  keys=None):
+    '''Burn the geometries into label rasters of the given shape, the
+    geometry at index i being burnt with the value i + 1.
+
+    The pixels are burnt with the all_touched semantics. A pixel may then
+    be touched by several geometries, so the geometries are spread over
+    several rasters according to their colors (see color_boxes): two
+    geometries which may touch the same pixel never share a raster.
+
+    When a cache is given, `keys` identify the geometries in the cache.'''
+    rasters = []
+    for color in sorted(set(colors)):
+        indices = [i for i in range(len(geometries)) if colors[i] == color]
+
+        if cache is not None:
+            cache_key = cache.key([(i, keys[i]) for i in indices],
+                                  tuple(transform), tuple(shape))
+            raster = cache.get_labels(cache_key)
+            if raster is not None:
+                rasters.append(raster)
+                continue
+
+        raster = features.rasterize(
+            [(geometries[i], i + 1) for i in indices],
+            out_shape=shape,
+            transform=transform,
+            all_touched=True,
+            dtype=rasterio.int32)
+
+        if cache is not None:
+            cache.put_labels(cache_key, raster)
+        rasters.append(raster)
+    return rasters
+
+
+def pixel_boxes(geometries, shape, transform):
+    '''Return the (row_start, row_stop, col_start, col_stop) boxes of the
+    pixels each geometry may touch, padded by one pixel. The box is None
+    for geometries out of the grid.'''
+    height, width = shape
+    inverse = ~transform
+    boxes = []
+    for geometry in geometries:
+        minx, miny, maxx, maxy = geometry.bounds
+        cols, rows = zip(*[inverse * corner for corner in (
+            (minx, miny), (minx, maxy), (maxx, maxy), (maxx, miny))])
+        row_start = max(int(math.floor(min(rows))) - 1, 0)
+        row_stop = min(int(math.floor(max(rows))) + 2, height)
+        col_start = max(int(math.floor(min(cols))) - 1, 0)
+        col_stop = min(int(math.floor(max(cols))) + 2, width)
+        if row_start >= row_stop or col_start >= col_stop:
+            boxes.append(None)
+        else:
+            boxes.append((row_start, row_stop, col_start, col_stop))
+    return boxes
+
+
+def color_boxes(boxes):
+    '''Greedily assign a color to each box so that two overlapping boxes
+    never get the same color. Boxes are bucketed by tiles to only compare
+    the neighbouring ones.'''
+    sizes = sorted(max(box[1] - box[0], box[3] - box[2])
+                   for box in boxes if box is not None)
+    tile = max(16, sizes[len(sizes) // 2] if sizes else 0)
+
+    colors = []
+    tiles = {}
+    for i, box in enumerate(boxes):
+        if box is None:
+            colors.append(0)
+            continue
+        row_start, row_stop, col_start, col_stop = box
+        rows = range(row_start // tile, (row_stop - 1) // tile + 1)
+        cols = range(col_start // tile, (col_stop - 1) // tile + 1)
+        keys = [(row, col) for row in rows for col in cols]
+        used = set()
+        for key in keys:
+            for j in tiles.get(key, ()):
+                other = boxes[j]
+                if other[0] < row_stop and row_start < other[1] and \
+                        other[2] < col_stop and col_start < other[3]:
+                    used.add(colors[j])
+        color = 0
+        while color in used:
+            color += 1
+        colors.append(color)
+        for key in keys:
+            tiles.setdefault(key, []).append(i)
+    return colors
+
+
+def labels_any(labels, pixels, count):
+    '''Tell for each of the `count` labels whether any of its pixels is
+    set in the `pixels` boolean array.'''
+    return labels_count(labels, pixels, count) > 0
+
+
+def labels_count(labels, pixels, count):
+    '''Count for each of the `count` labels its pixels which are set in
+    the `pixels` boolean array, or all its pixels if `pixels` is None.'''
+    result = numpy.zeros(count + 1, dtype=numpy.int64)
+    for raster in labels:
+        # the labels selected in a raster, and their copy by bincount,
+        # are dropped before the next one
+        result += numpy.bincount(
+            raster.ravel() if pixels is None else raster[pixels],
+            minlength=count + 1)
+    return result[1:]
+
+
+def hazardlevel_codes(valid, positive):
+    '''Apply the hazard level rules of admindiv_hazardlevel to arrays of
+    flags telling for each division and level whether the division has
+    data (valid) and values above the threshold (positive) in the layer.
+    Return the array of the hazard level codes of the divisions.'''
+    count = len(valid[u'HIG'])
+    codes = numpy.zeros(count, dtype=numpy.uint8)
+    done = numpy.zeros(count, dtype=bool)
+    for level in (u'HIG', u'MED', u'LOW'):
+        # a layer without data in the division stops the search
+        done |= ~valid[level]
+        codes[~done & (codes == 0)] = HAZARDLEVEL_CODES.index(u'VLO')
+        found = ~done & positive[level]
+        codes[found] = HAZARDLEVEL_CODES.index(level)
+        done |= found
+    return codes
+
+
+def polygonFromBounds(bounds):
+    return Polygon([
+        (bounds[0], bounds[1]),
+        (bounds[0], bounds[3]),
+        (bounds[2], bounds[3]),
+        (bounds[2], bounds[1]),
+        (bounds[0], bounds[1])])